@@ -0,0 +1,258 @@
+"""
+Jinja2JS benchmarks
+
+Measures how long templates take to compile to JS, how long the extractor
+takes to run with cold and warm caches with each of its engines, the peak
+memory used while doing so, and the size of the generated JS and JSON, for a
+generated corpus of templates of different sizes and nesting depths, which
+use loops, includes, macros, and filters as well as plain output.
+
+Usage:
+  run.py [--output=<file>] [--compare=<file>] [--repeat=<n>]
+
+Options:
+  --output=<file>   Write the results to this file as JSON. They are printed
+                    if this is not given.
+  --compare=<file>  Print how the results differ from the results in this
+                    file, which was written by an earlier run.
+  --repeat=<n>      The number of times that each measurement is repeated.
+                    The fastest time is kept [default: 20].
+"""
+
+import json
+from multiprocessing import Pool
+import os
+import resource
+import subprocess
+import sys
+import time
+
+from docopt import docopt
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                ".."))
+
+import jinja2
+
+import jinja2js
+from jinja2js.ir import build_ir
+from jinja2js.jscompiler import JSVisitor
+
+
+# The features that templates of the corpus can use besides plain output.
+FEATURES = ("loops", "includes", "macros", "filters")
+
+# (name, blocks, rows per block, nesting depth, features)
+CORPUS = [
+    ("small", 1, 5, 1, ()),
+    ("medium", 4, 20, 2, ()),
+    ("large", 8, 50, 3, ()),
+    ("deep", 2, 10, 8, ()),
+    ("loops", 4, 20, 2, ("loops",)),
+    ("includes", 4, 20, 2, ("includes",)),
+    ("macros", 4, 20, 2, ("macros",)),
+    ("filters", 4, 20, 2, ("filters",)),
+    ("mixed", 8, 50, 3, FEATURES),
+]
+
+# The templates that the corpus includes and imports.
+INCLUDED = {
+    "header.html": '<h1>{{ title }}</h1>\n<p>{{ item0.name }}</p>\n',
+    "entry.html": '<li>{{ entry.name }} {{ entry.price }}</li>\n',
+    "macros.html": '{% macro link(item) %}'
+                   '<a href="{{ item.url }}">{{ item.name }}</a>'
+                   '{% endmacro %}',
+}
+
+
+class MockRequest(object):
+
+    def __init__(self):
+        self.GET = {}
+        self.POST = {}
+
+
+class Item(object):
+
+    def __init__(self, index):
+        self.name = "Item %d" % index
+        self.url = "/items/%d/" % index
+        self.price = index * 1.5
+
+
+def make_template(blocks, rows, depth, features=()):
+    """
+    Returns the source of a template with `blocks` blocks, each of which
+    outputs `rows` rows wrapped in `depth` nested conditionals, using the
+    `features` that are named.
+    """
+    source = []
+    if "macros" in features:
+        source.append('{% from "macros.html" import link %}\n')
+    for block in range(blocks):
+        source.append("{%% block block%d %%}\n<section>\n" % block)
+        if "includes" in features:
+            source.append('{% include "header.html" %}\n')
+        for level in range(depth):
+            source.append("%s{%% if flag%d %%}\n" % ("  " * level, level))
+        if "loops" in features:
+            source.append(
+                '<ul>{% for entry in entries %}'
+                '<li class="{{ loop.cycle("odd", "even") }}">'
+                '{{ loop.index }}. {{ entry.name }}</li>'
+                '{% else %}<li>{{ _("None") }}</li>{% endfor %}</ul>\n')
+            if "includes" in features:
+                source.append('<ul>{% for entry in entries %}'
+                              '{% include "entry.html" %}{% endfor %}</ul>\n')
+        for row in range(rows):
+            source.append(
+                '<div class="row">\n'
+                '  <a href="{{ item%(row)d.url }}">{{ item%(row)d.name }}</a>\n'
+                '  <span>{{ prices["item%(row)d"] }}</span>\n'
+                '  {%% if show_names %%}{{ item%(row)d.name }}{%% else %%}'
+                '{{ _("Hidden") }}{%% endif %%}\n' % {"row": row})
+            if "macros" in features:
+                source.append("  {{ link(item%d) }}\n" % row)
+            if "filters" in features:
+                source.append(
+                    '  {{ item%(row)d.name|upper }} {{ tags|join(", ") }} '
+                    '{{ tags|length }} {{ missing|default("-") }} '
+                    '{{ item%(row)d.name|title }}\n' % {"row": row})
+            source.append("</div>\n")
+        for level in reversed(range(depth)):
+            source.append("%s{%% else %%}{{ empty%d }}{%% endif %%}\n" %
+                          ("  " * level, level))
+        source.append("</section>\n{% endblock %}\n")
+    return "".join(source)
+
+
+def make_context(rows, depth):
+    context = {"show_names": True, "prices": {}, "title": "Items",
+               "entries": [Item(row) for row in range(rows)],
+               "tags": ["new", "sale", "popular"]}
+    for row in range(rows):
+        context["item%d" % row] = Item(row)
+        context["prices"]["item%d" % row] = "$%.2f" % (row * 1.5)
+    for level in range(depth):
+        context["flag%d" % level] = True
+        context["empty%d" % level] = "Nothing here."
+    return context
+
+
+def best_of(repeat, function):
+    """Returns the fastest of `repeat` runs of `function`, in milliseconds."""
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        function()
+        times.append(time.time() - start)
+    return min(times) * 1000
+
+
+def measure(case):
+    """
+    Runs every measurement for one template of the corpus. This is run in a
+    fresh process so that the peak memory use of each case is separate.
+    """
+    (name, blocks, rows, depth, features), repeat = case
+    source = make_template(blocks, rows, depth, features)
+    context = make_context(rows, depth)
+    sources = dict(INCLUDED, **{name: source})
+
+    # Jinja's DictLoader always reports templates as out of date, which
+    # would defeat the extractor cache.
+    env = jinja2.Environment(loader=jinja2.FunctionLoader(
+            lambda template: (sources[template], None, lambda: True)))
+    env.add_extension("jinja2.ext.i18n")
+    jinja2js.set_env(env)
+    request = MockRequest()
+
+    def compile_js():
+        return JSVisitor().compile(build_ir(env, source))
+
+    def extract_cold():
+        jinja2js.revrender.clear_caches()
+        return jinja2js.extract_template(request, name, context)
+
+    def extract_warm():
+        return jinja2js.extract_template(request, name, context)
+
+    js = compile_js()
+    payload = json.dumps(extract_cold())
+
+    timings = {}
+    for engine in jinja2js.extractor.ENGINES:
+        jinja2js.set_engine(engine)
+        # The default engine's timings keep their original names so that
+        # they can be compared with earlier runs.
+        prefix = "extract" if engine == "codegen" else engine
+        timings[prefix + "_cold_ms"] = best_of(repeat, extract_cold)
+        timings[prefix + "_warm_ms"] = best_of(repeat, extract_warm)
+    jinja2js.set_engine("codegen")
+
+    result = {
+        "name": name,
+        "blocks": blocks,
+        "rows": rows,
+        "depth": depth,
+        "features": list(features),
+        "template_bytes": len(source),
+        "compile_ms": best_of(repeat, compile_js),
+        "js_bytes": len(js),
+        "json_bytes": len(payload),
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+    result.update(timings)
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+                ["git", "rev-parse", "HEAD"],
+                cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(previous, current):
+    """Prints the relative change of each measurement between two runs."""
+    before = dict((result["name"], result) for result in
+                  previous["results"])
+    for result in current["results"]:
+        old = before.get(result["name"])
+        if old is None:
+            continue
+        print "%s:" % result["name"]
+        for key in sorted(result):
+            if not key.endswith(("_ms", "_bytes", "_kb")) or not old.get(key):
+                continue
+            change = 100.0 * (result[key] - old[key]) / old[key]
+            print "  %-16s %12.2f -> %12.2f  (%+.1f%%)" % (key, old[key],
+                                                          result[key], change)
+
+
+if __name__ == "__main__":
+    arguments = docopt(__doc__)
+    repeat = int(arguments["--repeat"])
+
+    pool = Pool(1, maxtasksperchild=1)
+    try:
+        results = pool.map(measure, [(case, repeat) for case in CORPUS],
+                           chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    output = {"revision": git_revision(), "version": jinja2js.__version__,
+              "python": sys.version.split()[0], "results": results}
+
+    if arguments["--output"]:
+        with open(arguments["--output"], "w") as fd:
+            json.dump(output, fd, indent=2, sort_keys=True)
+    else:
+        print json.dumps(output, indent=2, sort_keys=True)
+
+    if arguments["--compare"]:
+        with open(arguments["--compare"]) as fd:
+            compare(json.load(fd), output)
@@ -1,4 +1,9 @@
-from revrender import extract, extract_template, set_env
+__version__ = "0.9.0"
+
+from extractor import Extractor, provides
+from revrender import (extract, extract_delta, extract_template,
+                       set_bytecode_cache, set_engine, set_env)
+from warmup import warmup
 
 
 renderers = []
@@ -18,9 +23,11 @@ except ImportError:
     pass
 
 
-def render_or_extract(request, template, context=None, **kwargs):
+def render_or_extract(request, template, context=None, compact=False,
+                      delta=False, blocks=None, **kwargs):
     if request.is_ajax():
-        return extract(request, template, context, **kwargs)
+        return extract(request, template, context, compact, delta, blocks,
+                       **kwargs)
 
     if renderers:
         return renderers[0](request, template, context, **kwargs)
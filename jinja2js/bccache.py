@@ -0,0 +1,40 @@
+"""
+Persistent caches for the bytecode of compiled extractors. These reuse Jinja's
+bytecode cache buckets, but keep extractor bytecode separate from Jinja's own
+template bytecode and throw it away whenever the version of Jinja2JS or the
+format of the extractors that it generates changes.
+"""
+
+from jinja2.bccache import FileSystemBytecodeCache, MemcachedBytecodeCache
+
+from jsonextractor import FORMAT_VERSION
+
+
+class ExtractorCacheMixin(object):
+    """
+    Mix into any `jinja2.bccache.BytecodeCache` subclass to store extractor
+    bytecode with it.
+    """
+
+    def get_cache_key(self, name, filename=None):
+        return super(ExtractorCacheMixin, self).get_cache_key(
+                "jinja2js|" + name, filename)
+
+    def get_source_checksum(self, source):
+        from jinja2js import __version__
+        return super(ExtractorCacheMixin, self).get_source_checksum(
+                u"%s|%s|%s" % (__version__, FORMAT_VERSION, source))
+
+
+class FileSystemExtractorCache(ExtractorCacheMixin, FileSystemBytecodeCache):
+    """Stores extractor bytecode in files in `directory`."""
+
+    def __init__(self, directory=None, pattern="__jinja2js_%s.cache"):
+        super(FileSystemExtractorCache, self).__init__(directory, pattern)
+
+
+class MemcachedExtractorCache(ExtractorCacheMixin, MemcachedBytecodeCache):
+    """Stores extractor bytecode in memcache."""
+
+    def __init__(self, client, prefix="jinja2js/bytecode/", timeout=None):
+        super(MemcachedExtractorCache, self).__init__(client, prefix, timeout)
@@ -0,0 +1,315 @@
+"""
+Compiles many templates at once into a single JS bundle which registers each
+`template(param)` function under the name of its template, and each template
+that is included under `modules`. Bundles start with the JS runtime that the
+templates share.
+"""
+
+from collections import OrderedDict
+from functools import partial
+from glob import glob
+from hashlib import sha1
+import json
+from multiprocessing import Pool
+import os
+import time
+
+from jinja2.environment import Environment
+from jinja2.loaders import FunctionLoader
+
+from ir import build_ir
+from jscompiler import JSVisitor, get_runtime
+
+
+# The environment that is used to parse templates. Each worker process creates
+# its own the first time that it compiles a template, and keeps the IR of each
+# template that is extended or included so that it's only built once.
+_environment = None
+
+# The paths of the templates that the environment can load, by name, so that
+# the templates that are extended can be found.
+_paths = {}
+
+
+# The JS of the templates that are included, by name, so that each is only
+# compiled once by each process.
+_modules = {}
+
+
+def set_templates(templates):
+    """Sets the `(name, path)` pairs that the environment can load."""
+    _paths.clear()
+    _paths.update(templates)
+    _modules.clear()
+
+
+def load_template(name):
+    path = _paths.get(name)
+    if path is None:
+        return None
+    mtime = os.path.getmtime(path)
+    with open(path) as fd:
+        source = fd.read().decode("utf-8")
+    return (source, path,
+            lambda: os.path.exists(path) and os.path.getmtime(path) == mtime)
+
+
+def get_environment():
+    global _environment
+    if _environment is None:
+        _environment = Environment(loader=FunctionLoader(load_template))
+        _environment.add_extension("jinja2.ext.i18n")
+    return _environment
+
+
+def find_templates(paths):
+    """
+    Expands a list of files, directories, and glob patterns into a list of
+    `(name, path)` pairs. Templates found in a directory are named by their
+    path relative to that directory; other templates are named by the path
+    that was given.
+    """
+    templates = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for filename in sorted(files):
+                    full_path = os.path.join(root, filename)
+                    name = os.path.relpath(full_path, path)
+                    templates.append((name.replace(os.sep, "/"), full_path))
+            continue
+
+        matches = sorted(glob(path)) if not os.path.exists(path) else [path]
+        for match in matches:
+            if os.path.isfile(match):
+                templates.append((match.replace(os.sep, "/"), match))
+
+    return templates
+
+
+def compile_modules(ir, **options):
+    """
+    Returns the JS of every template that a template's IR includes or
+    imports, directly or through other templates, by name. `options` are
+    passed on to `JSVisitor`.
+    """
+    modules = OrderedDict()
+    for module in ir.modules():
+        if module.name not in _modules:
+            _modules[module.name] = JSVisitor(**options).compile_module(
+                    module)
+        modules[module.name] = _modules[module.name]
+    return modules
+
+
+def compile_file(template, optimized=True, **options):
+    """
+    Compiles a `(name, path)` pair, optimizing it first unless `optimized` is
+    false. `options` are passed on to `JSVisitor`. Returns the name, the JS
+    (or `None` if the template could not be compiled), the names of the
+    templates that it depends on, the JS of the templates that it includes by
+    name, the time it took in seconds, and the error message, if any.
+    """
+    name, path = template
+    start = time.time()
+    try:
+        with open(path) as fd:
+            ir = build_ir(get_environment(), fd.read().decode("utf-8"), name,
+                          optimized=optimized)
+        output = JSVisitor(**options).compile(ir)
+        modules = compile_modules(ir, **options)
+    except Exception, exc:
+        return name, None, [], {}, time.time() - start, "%s: %s" % (
+                type(exc).__name__, exc)
+    return name, output, ir.dependencies, modules, time.time() - start, None
+
+
+def compile_templates(templates, processes=None, optimized=True, known=None,
+                      **options):
+    """
+    Compiles `(name, path)` pairs across a pool of `processes` worker
+    processes (one per CPU by default) and returns the results of
+    `compile_file` in the same order. The templates that they extend are
+    loaded from `known`, another list of pairs, which defaults to `templates`.
+    """
+    if known is None:
+        known = templates
+    compile = partial(compile_file, optimized=optimized, **options)
+    if processes == 1 or len(templates) < 2:
+        set_templates(known)
+        return map(compile, templates)
+
+    pool = Pool(processes, set_templates, (known,))
+    try:
+        return pool.map(compile, templates)
+    finally:
+        pool.close()
+        pool.join()
+
+
+BUNDLE_HEADER = ("var templates = templates || {};\n"
+                 "var modules = modules || {};\n")
+
+
+def write_header(fd):
+    """Writes the start of a bundle, which includes the JS runtime."""
+    fd.write(BUNDLE_HEADER)
+    fd.write(get_runtime())
+
+
+def bundle_line(name, output, registry="templates"):
+    """
+    Returns the line of the bundle that registers a compiled template in
+    `registry`, which is "templates" or "modules".
+    """
+    return "%s[%s] = %s;\n" % (registry, json.dumps(name), output)
+
+
+def write_bundle(fd, compiled, modules=()):
+    """
+    Writes a bundle containing `(name, output)` pairs of compiled templates to
+    a file-like object, along with `(name, output)` pairs of the templates
+    that they include. Each template that is included is registered once,
+    however many templates include it.
+    """
+    write_header(fd)
+    written = set()
+    for name, output in modules:
+        if name not in written:
+            written.add(name)
+            fd.write(bundle_line(name, output, "modules"))
+    for name, output in compiled:
+        fd.write(bundle_line(name, output))
+
+
+def read_bundle(fd, registry="templates"):
+    """
+    Reads a bundle written by `write_bundle`, returning an ordered mapping of
+    the names of the templates in `registry` to the lines that register them.
+    """
+    prefix = registry + "["
+    lines = OrderedDict()
+    for line in fd:
+        if not line.startswith(prefix):
+            continue
+        name = json.loads(line[len(prefix):line.index("] = ")])
+        lines[name] = line
+    return lines
+
+
+def source_hash(path):
+    with open(path, "rb") as fd:
+        return sha1(fd.read()).hexdigest()
+
+
+def dependents(manifest, names):
+    """
+    Returns `names` along with every template in the manifest that depends on
+    any of them, directly or through other templates.
+    """
+    reverse = {}
+    for name, entry in manifest.items():
+        for dependency in entry["dependencies"]:
+            reverse.setdefault(dependency, set()).add(name)
+
+    found = set()
+    pending = list(names)
+    while pending:
+        name = pending.pop()
+        if name in found:
+            continue
+        found.add(name)
+        pending.extend(reverse.get(name, ()))
+    return found
+
+
+def update_bundle(paths, output, manifest_path=None, processes=None,
+                  optimized=True, **options):
+    """
+    Brings the bundle at `output` up to date with the templates found in
+    `paths`. Only templates whose source changed since the last update, and
+    the templates that depend on them, are compiled again. The source hashes
+    and dependencies of every template, and the templates that each
+    includes, are kept in a manifest next to the bundle
+    (`<output>.manifest` unless `manifest_path` is given).
+
+    Returns the results of `compile_file` for the templates that were
+    compiled, including those that failed to compile last time. `optimized`
+    and `options` are passed on to `compile_templates`.
+    """
+    if manifest_path is None:
+        manifest_path = output + ".manifest"
+
+    manifest = {}
+    lines = OrderedDict()
+    module_lines = OrderedDict()
+    if os.path.exists(output) and os.path.exists(manifest_path):
+        with open(manifest_path) as fd:
+            manifest = json.load(fd)
+        with open(output) as fd:
+            bundle = fd.readlines()
+        lines = read_bundle(bundle)
+        module_lines = read_bundle(bundle, "modules")
+
+    templates = find_templates(paths)
+    current = dict(templates)
+
+    # Templates that couldn't be compiled are missing from the bundle, and are
+    # tried again each time, since the templates that they need may exist now.
+    changed = set()
+    for name, path in templates:
+        entry = manifest.get(name)
+        mtime = os.path.getmtime(path)
+        if (entry is not None and entry["mtime"] == mtime and
+                name in lines):
+            continue
+        digest = source_hash(path)
+        if entry is None or entry["hash"] != digest or name not in lines:
+            changed.add(name)
+        manifest[name] = {"path": path, "mtime": mtime, "hash": digest,
+                          "dependencies": entry["dependencies"] if entry else
+                                          [],
+                          "modules": entry.get("modules", []) if entry else
+                                     []}
+
+    removed = set(manifest) - set(current)
+    for name in removed:
+        del manifest[name]
+        lines.pop(name, None)
+
+    dirty = dependents(manifest, changed | removed) - removed
+    results = compile_templates([(name, current[name]) for name, path in
+                                 templates if name in dirty], processes,
+                                optimized, templates, **options)
+
+    for name, js, dependencies, modules, seconds, error in results:
+        if error is not None:
+            lines.pop(name, None)
+            manifest[name]["modules"] = []
+            continue
+        manifest[name]["dependencies"] = dependencies
+        manifest[name]["modules"] = list(modules)
+        lines[name] = bundle_line(name, js)
+        for module, module_js in modules.items():
+            module_lines[module] = bundle_line(module, module_js, "modules")
+
+    # Templates that nothing includes any more are dropped.
+    included = set(module for entry in manifest.values() for module in
+                   entry.get("modules", ()))
+    for name in list(module_lines):
+        if name not in included:
+            del module_lines[name]
+
+    if results or removed or not os.path.exists(output):
+        temporary = output + ".tmp"
+        with open(temporary, "w") as fd:
+            write_header(fd)
+            fd.writelines(module_lines.values())
+            fd.writelines(lines.values())
+        os.rename(temporary, output)
+
+    with open(manifest_path, "w") as fd:
+        json.dump(manifest, fd, indent=1, sort_keys=True)
+
+    return results
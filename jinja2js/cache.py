@@ -0,0 +1,104 @@
+from threading import Lock, RLock
+from weakref import WeakSet, ref
+
+from jinja2.utils import LRUCache
+
+
+# The number of compiled templates that each cache keeps for an environment.
+# The least recently used template is dropped when the limit is reached.
+CACHE_SIZE = 50
+
+state_lock = Lock()
+
+
+def environment_state(environment):
+    """
+    Returns the dict that Jinja2JS keeps what it caches for an environment
+    in. It is stored on the environment itself, like Jinja's own template
+    cache, so that it is dropped along with the environment even though what
+    it holds refers back to it. Overlays get a dict of their own.
+    """
+    owner, state = getattr(environment, "jinja2js_state", (None, None))
+    if owner is None or owner() is not environment:
+        with state_lock:
+            owner, state = getattr(environment, "jinja2js_state",
+                                   (None, None))
+            if owner is None or owner() is not environment:
+                state = {}
+                environment.jinja2js_state = ref(environment), state
+    return state
+
+
+class CompilationCache(object):
+    """
+    Caches the output of `compile(environment, template)` for each environment
+    and template name. `compile` must return the compiled value along with the
+    loader's `uptodate` callable, which is used to throw away stale entries
+    like Jinja does for its own templates. What is compiled usually refers to
+    the environment, so each environment's cache is kept on the environment
+    (see `environment_state`).
+    """
+
+    def __init__(self, compile, size=CACHE_SIZE):
+        self.compile = compile
+        self.size = size
+        # The environments that have a cache.
+        self._environments = WeakSet()
+        # Held while compiling, so that a template isn't compiled by several
+        # threads at once. Cache hits don't take it.
+        self._lock = RLock()
+
+    def get_cache(self, environment):
+        """Returns the cache for `environment`, creating it if needed."""
+        state = environment_state(environment)
+        cache = state.get(self)
+        if cache is None:
+            with self._lock:
+                cache = state.get(self)
+                if cache is None:
+                    cache = state[self] = LRUCache(self.size)
+                    self._environments.add(environment)
+        return cache
+
+    def reserve(self, environment, size):
+        """Makes the cache for `environment` hold at least `size` templates."""
+        cache = self.get_cache(environment)
+        with self._lock:
+            cache.capacity = max(cache.capacity, size)
+
+    def lookup(self, environment, cache, template):
+        """Returns the cached value for a template if it is up to date."""
+        cached = cache.get(template)
+        if cached is not None:
+            value, uptodate = cached
+            if (not environment.auto_reload or uptodate is None or
+                uptodate()):
+                return cached
+        return None
+
+    def get(self, environment, template):
+        """
+        Returns the compiled value for the named template, compiling it if it
+        is not cached or the cached copy is out of date. This is safe to call
+        from several threads at once.
+        """
+        cache = self.get_cache(environment)
+        cached = self.lookup(environment, cache, template)
+        if cached is not None:
+            return cached[0]
+
+        with self._lock:
+            # Another thread may have compiled it while this one waited.
+            cached = self.lookup(environment, cache, template)
+            if cached is not None:
+                return cached[0]
+            value, uptodate = self.compile(environment, template)
+            cache[template] = value, uptodate
+            return value
+
+    def clear(self):
+        """Drops every cached value for every environment."""
+        with self._lock:
+            for environment in list(self._environments):
+                environment_state(environment).pop(self, None)
+            self._environments.clear()
@@ -1,6 +1,7 @@
 
 def prepare_const(data):
-    value = str(data)
+    value = unicode(data)
+    value = value.replace("\\", "\\\\")
     value = value.replace("\n", "\\n")
     value = value.replace("\t", "\\t")
     value = value.replace("\r", "\\r")
@@ -0,0 +1,435 @@
+"""
+Extracts the values that templates use, for the JS that `compile_to_js.py`
+compiles them to.
+"""
+
+from hashlib import sha1
+import json
+import zlib
+
+import jinja2.environment
+from jinja2.runtime import new_context
+from jinja2.utils import LRUCache
+
+from cache import CACHE_SIZE, CompilationCache
+from interpreter import compile_interpreter
+from ir import get_ir
+from jsonextractor import JSONVisitor
+from values import Entries, client_value, raw_value
+
+
+# The engines that extractors can be built with. "codegen" generates Python
+# source for each template and compiles it, which makes for the fastest
+# extraction; "interpreter" runs the template's IR directly, which is quicker
+# to build and doesn't need the bytecode cache.
+ENGINES = ("codegen", "interpreter")
+
+# The header that payload tokens are sent back and forth in.
+TOKEN_HEADER = "X-Jinja2JS-Token"
+
+# The number of serialized payloads that each extractor keeps, by their
+# digest.
+BODY_CACHE_SIZE = 200
+
+# The context keys that Django's own context processors provide, by the
+# processor's import path.
+PROCESSOR_KEYS = {
+    "django.contrib.auth.context_processors.auth": ("user", "perms"),
+    "django.contrib.messages.context_processors.messages": ("messages",),
+    "django.core.context_processors.csrf": ("csrf_token",),
+    "django.core.context_processors.debug": ("debug", "sql_queries"),
+    "django.core.context_processors.i18n": ("LANGUAGES", "LANGUAGE_CODE",
+                                            "LANGUAGE_BIDI"),
+    "django.core.context_processors.media": ("MEDIA_URL",),
+    "django.core.context_processors.request": ("request",),
+    "django.core.context_processors.static": ("STATIC_URL",),
+    "django.core.context_processors.tz": ("TIME_ZONE",),
+}
+
+try:
+    from django import http
+except ImportError:
+    http = None
+
+
+def compile_extractor(environment, template, bytecode_cache=None):
+    """
+    Compiles the extractor for the named template. Returns the `root` function
+    of the generated module along with the `uptodate` callable for the
+    template and the templates that it extends or includes. The generated code
+    is stored in `bytecode_cache`, if it is given.
+    """
+    if environment.loader is None:
+        raise TypeError("The environment does not have a configured loader.")
+
+    source, filename, uptodate = environment.loader.get_source(environment,
+                                                               template)
+
+    bucket = None
+    namespace = None
+    if bytecode_cache is not None:
+        bucket = bytecode_cache.get_bucket(environment, template, filename,
+                                           source)
+        if bucket.code is not None:
+            namespace = load_extractor(bucket.code)
+            # The extractor also takes the steps of the templates that the
+            # template extends or includes, so it is out of date once any of
+            # them changes. Their checksums are stored with it, so that
+            # nothing is parsed to check them.
+            checks = [uptodate]
+            for other, checksum in namespace["dependencies"]:
+                other_source, _, other_uptodate = (
+                        environment.loader.get_source(environment, other))
+                if (bytecode_cache.get_source_checksum(other_source) !=
+                    checksum):
+                    namespace = None
+                    break
+                checks.append(other_uptodate)
+            else:
+                checks = [check for check in checks if check is not None]
+                uptodate = lambda: all(check() for check in checks)
+
+    if namespace is None:
+        ir = get_ir(environment, template)
+        compiler = JSONVisitor(environment, template, filename)
+        compiler.generate(ir)
+        gen_python = compiler.stream.getvalue()
+        if bytecode_cache is not None:
+            dependencies = tuple(
+                    (other.name, bytecode_cache.get_source_checksum(
+                        environment.loader.get_source(environment,
+                                                      other.name)[0]))
+                    for other in ir.templates()[1:])
+            gen_python += "\ndependencies = %r\n" % (dependencies,)
+
+        compiled = compile(gen_python, filename or "<template>", "exec")
+        if bucket is not None:
+            bucket.code = compiled
+            bytecode_cache.set_bucket(bucket)
+        namespace = load_extractor(compiled)
+        uptodate = ir.uptodate
+
+    root = namespace["root"]
+    # The slot table that compact payloads are ordered by.
+    root.keys = namespace["keys"]
+    root.slot_hash = namespace["slot_hash"]
+    root.block_keys = namespace["block_keys"]
+    root.names = namespace["names"]
+    root.raw = namespace["raw"]
+    return root, uptodate
+
+
+def load_extractor(compiled):
+    """Runs the compiled module of an extractor and returns its namespace."""
+    namespace = {"Entries": Entries, "client_value": client_value,
+                 "raw_value": raw_value}
+    exec compiled in namespace
+    return namespace
+
+
+def provides(*keys):
+    """
+    Declares the context keys that a context processor provides, so that it
+    is only run for templates that read one of them:
+
+        @jinja2js.provides("cart")
+        def cart(request):
+            return {"cart": Cart.objects.get(user=request.user)}
+
+    Processors that don't declare their keys are run for every template.
+    """
+    def decorate(processor):
+        processor.jinja2js_provides = frozenset(keys)
+        return processor
+    return decorate
+
+
+def processor_keys(processor):
+    """
+    Returns the set of context keys that a context processor provides, or
+    `None` if they are not known.
+    """
+    keys = getattr(processor, "jinja2js_provides", None)
+    if keys is None:
+        path = "%s.%s" % (getattr(processor, "__module__", None),
+                          getattr(processor, "__name__", None))
+        keys = PROCESSOR_KEYS.get(path)
+    return keys
+
+
+def block_keys(root, blocks):
+    """
+    Returns the set of keys that the named blocks read, or `None` if every
+    block is used.
+    """
+    if blocks is None:
+        return None
+    keys = set()
+    for block in blocks:
+        keys.update(root.block_keys.get(block, ()))
+    return keys
+
+
+def value_hash(value):
+    """Returns a short hash of an extracted value for payload tokens."""
+    return "%08x" % (zlib.crc32(json.dumps(value)) & 0xffffffff)
+
+
+def payload_token(root, output):
+    """
+    Returns the token for a payload: the hash of the slot table followed by
+    the hash of each value, in slot order.
+    """
+    return "%s:%s" % (root.slot_hash, "".join(value_hash(output.get(key)) for
+                                              key in root.keys))
+
+
+def payload_digest(payload):
+    """
+    Returns a stable digest of an extracted payload, which is used as its
+    ETag. Extracted values are canonical (see `jinja2js.values`): strings are
+    unicode and the keys of dicts are sorted, so their `repr` is the same for
+    equal payloads and much cheaper to build than their JSON.
+    """
+    if isinstance(payload, dict):
+        payload = sorted((unicode(key), value) for key, value in
+                         payload.items())
+    return sha1(repr(payload)).hexdigest()[:16]
+
+
+def etag_matches(request, etag):
+    """Returns whether the request's `If-None-Match` header matches `etag`."""
+    header = request.META.get("HTTP_IF_NONE_MATCH")
+    if not header:
+        return False
+    for tag in header.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == "*" or tag == etag:
+            return True
+    return False
+
+
+class Extractor(object):
+    """
+    Extracts the values that the templates of one environment use. Each
+    extractor owns the caches of what it compiles and serializes, and is safe
+    to share between threads: cache hits are read without taking a lock, and
+    only compiling a template that isn't cached does.
+
+    `cache_size` is the number of compiled extractors that are kept. The
+    least recently used one is dropped when the limit is reached.
+    """
+
+    def __init__(self, environment, engine="codegen", bytecode_cache=None,
+                 cache_size=CACHE_SIZE):
+        if engine not in ENGINES:
+            raise ValueError("There is no extractor engine named %r." %
+                             engine)
+        self.environment = environment
+        self.engine = engine
+        # If set, the bytecode of compiled extractors is stored here so that
+        # new processes do not have to generate it again. See
+        # `jinja2js.bccache`. This is only used by the "codegen" engine.
+        self.bytecode_cache = bytecode_cache
+
+        self.cache = CompilationCache(self.compile, cache_size)
+        # Serialized payloads, keyed by their digest, so that identical
+        # payloads (across users, for instance) are only serialized once.
+        self.bodies = LRUCache(BODY_CACHE_SIZE)
+
+    def compile(self, environment, template):
+        if self.engine == "interpreter":
+            return compile_interpreter(environment, template)
+        return compile_extractor(environment, template, self.bytecode_cache)
+
+    def get(self, template):
+        """
+        Returns the compiled extractor for the named template, compiling it if
+        it is not cached or the cached copy is out of date.
+        """
+        if isinstance(template, jinja2.environment.Template):
+            raise Exception("Pre-compiled templates may not be used with the "
+                            "Jinja2JS extractor.")
+        return self.cache.get(self.environment, template)
+
+    def clear(self):
+        """Drops every compiled extractor and serialized payload."""
+        self.cache.clear()
+        self.bodies.clear()
+
+    # Extraction happens in three steps, which `run` takes one after the
+    # other: the context processors that the template needs are run, the
+    # extractor is run on the gathered context, and the values it extracted
+    # are turned into a payload. Callers that don't want to block while
+    # processors do I/O can take the steps themselves, running `processors`
+    # concurrently however suits them and passing the gathered context to
+    # `evaluate`.
+
+    def processors(self, template):
+        """
+        Returns the Django context processors that can provide something that
+        the named template reads, in the order that they are run.
+        """
+        try:
+            from django.template.context import get_standard_processors
+        except ImportError:
+            return []
+
+        names = self.get(template).names
+        # Skip the processors that can't provide anything that the template
+        # reads.
+        return [processor for processor in get_standard_processors() if
+                processor_keys(processor) is None or
+                not names.isdisjoint(processor_keys(processor))]
+
+    def evaluate(self, template, context, blocks=None):
+        """
+        Runs the extractor for the named template on a context that has
+        already been gathered. Returns the extractor along with the values
+        that it extracted, by key.
+
+        If `blocks` is given, only the values that the named blocks read are
+        extracted.
+        """
+        env = self.environment
+        root = self.get(template)
+
+        jinj_context = new_context(env, None, blocks={}, vars=context,
+                                   globals=env.globals)
+        root(jinj_context, env, blocks)
+        vars = jinj_context.vars
+        selected = block_keys(root, blocks)
+        output = {}
+        for key, var in vars.items():
+            if selected is not None and key not in selected:
+                continue
+            output[key] = (raw_value(var) if key in root.raw else
+                           client_value(var))
+        return root, output
+
+    def run(self, request, template, context=None, blocks=None):
+        """
+        Gathers the context for the named template and runs its extractor on
+        it. See `evaluate`.
+        """
+        c = {} if context is None else context.copy()
+        for processor in self.processors(template):
+            c.update(processor(request))
+        return self.evaluate(template, c, blocks)
+
+    def payload(self, root, output, compact=False):
+        """
+        Returns the payload for the values that an extractor extracted, as
+        `extract_template` returns it.
+        """
+        if compact:
+            return [root.slot_hash] + [output.get(key) for key in root.keys]
+        return output
+
+    def extract_template(self, request, template, context=None,
+                         compact=False, blocks=None):
+        """
+        Extracts the values used in the template along with the rendered
+        versions of those values.
+
+        If `compact` is true, the values are returned as a list in slot order
+        instead, for templates compiled with `--compact`. The first item is
+        the hash of the slot table, and values that the template did not read
+        are `None`.
+
+        If `blocks` is given, only the values that the named blocks read are
+        extracted and returned.
+        """
+        root, output = self.run(request, template, context, blocks)
+        return self.payload(root, output, compact)
+
+    def extract_delta(self, request, template, context=None, token=None,
+                      compact=False, blocks=None):
+        """
+        Extracts the values used in the template, leaving out the values that
+        have not changed since the payload that `token` was returned with.
+        Returns the payload along with the token for it, which the client
+        sends back with its next request.
+
+        Payloads that only hold changes are marked with a `__delta__` key, and
+        are merged into the client's last payload by templates compiled with
+        `--delta`. A full payload is returned if there is no token or it was
+        made for a different version of the template.
+
+        If `blocks` is given, only the values that the named blocks read are
+        compared, and the token keeps the client's hashes for the rest.
+        """
+        root, output = self.run(request, template, context, blocks)
+        selected = block_keys(root, blocks)
+
+        hashes = None
+        if token and token.startswith(root.slot_hash + ":"):
+            hashes = token[len(root.slot_hash) + 1:]
+            if len(hashes) != 8 * len(root.keys):
+                hashes = None
+
+        if hashes is None:
+            if not compact:
+                output = dict((key, output.get(key)) for key in root.keys if
+                              selected is None or key in selected)
+            return (self.payload(root, output, compact),
+                    payload_token(root, output))
+
+        payload = {"__delta__": 1}
+        if compact:
+            payload["0"] = root.slot_hash
+        new_hashes = []
+        for slot, key in enumerate(root.keys, 1):
+            old_hash = hashes[8 * (slot - 1):8 * slot]
+            if selected is not None and key not in selected:
+                new_hashes.append(old_hash)
+                continue
+            value = output.get(key)
+            new_hashes.append(value_hash(value))
+            if new_hashes[-1] != old_hash:
+                payload[str(slot) if compact else key] = value
+        return payload, "%s:%s" % (root.slot_hash, "".join(new_hashes))
+
+    def serialize(self, payload, digest=None):
+        """
+        Returns the JSON for a payload, reusing it if it was already built.
+        The payload's digest is taken if it isn't given.
+        """
+        if digest is None:
+            digest = payload_digest(payload)
+        body = self.bodies.get(digest)
+        if body is None:
+            body = self.bodies[digest] = json.dumps(payload)
+        return body
+
+    def extract(self, request, template, context=None, compact=False,
+                delta=False, blocks=None, **kwargs):
+        """
+        Returns a response with the JSON of the values used in the template.
+        See `extract_template` and `extract_delta`.
+        """
+        token = None
+        if delta:
+            extracted, token = self.extract_delta(
+                    request, template, context,
+                    request.META.get("HTTP_X_JINJA2JS_TOKEN"), compact,
+                    blocks)
+        else:
+            extracted = self.extract_template(request, template, context,
+                                              compact, blocks)
+
+        digest = payload_digest(extracted)
+        etag = '"%s"' % digest
+        if etag_matches(request, etag):
+            response = http.HttpResponseNotModified()
+        else:
+            kwargs.setdefault("content_type", "application/json")
+            response = http.HttpResponse(self.serialize(extracted, digest),
+                                         **kwargs)
+
+        response["ETag"] = etag
+        if token is not None:
+            response[TOKEN_HEADER] = token
+        return response
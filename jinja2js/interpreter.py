@@ -0,0 +1,440 @@
+"""
+An extractor engine that runs a template's IR directly, instead of generating
+Python source for it and compiling that. The steps of the IR are flattened
+into a list of instructions, and each expression is turned into a function of
+the context and the template's local variables, once per template.
+"""
+
+import operator
+
+from jinja2 import nodes
+from jinja2.runtime import (LoopContext, Markup, identity, markup_join,
+                            unicode_join)
+from jinja2.visitor import NodeVisitor
+
+from ir import Accessor, Assign, Block, Conditional, Loop, get_ir
+from values import Entries, client_value, raw_value
+
+
+# The instructions that programs are made of. Each instruction is a tuple
+# that starts with one of these. Values are stored in and read from a
+# location, which is a pair of the depth of the loop whose entries they are in
+# (or `None` for `context.vars`) and their field (or key).
+EVALUATE, ASSIGN, BRANCH, JUMP, SKIP_BLOCK, LOOP = range(6)
+
+BINARY_OPERATORS = {
+    "+": operator.add,
+    "-": operator.sub,
+    "*": operator.mul,
+    "/": operator.truediv,
+    "//": operator.floordiv,
+    "**": operator.pow,
+    "%": operator.mod,
+}
+
+UNARY_OPERATORS = {
+    "not": operator.not_,
+    "+": operator.pos,
+    "-": operator.neg,
+}
+
+COMPARE_OPERATORS = {
+    "eq": operator.eq,
+    "ne": operator.ne,
+    "gt": operator.gt,
+    "gteq": operator.ge,
+    "lt": operator.lt,
+    "lteq": operator.le,
+    "in": lambda a, b: a in b,
+    "notin": lambda a, b: a not in b,
+}
+
+
+class ExpressionCompiler(NodeVisitor):
+    """
+    Turns expressions into functions that take the context and a dict of the
+    template's local variables and return the expression's value, the same
+    way that Jinja's generated code would.
+    """
+
+    def __init__(self, environment):
+        self.environment = environment
+
+    def generic_visit(self, node):
+        raise TypeError("%s expressions are not supported by the extractor "
+                        "interpreter." % type(node).__name__)
+
+    def signature(self, node):
+        """
+        Returns a function that evaluates the arguments of a call, filter, or
+        test, returning the positional and keyword arguments.
+        """
+        args = map(self.visit, node.args)
+        kwargs = [(kwarg.key, self.visit(kwarg.value)) for kwarg in
+                  node.kwargs]
+        dyn_args = node.dyn_args and self.visit(node.dyn_args)
+        dyn_kwargs = node.dyn_kwargs and self.visit(node.dyn_kwargs)
+
+        def evaluate(context, scope):
+            values = [arg(context, scope) for arg in args]
+            keywords = dict((key, value(context, scope)) for key, value in
+                            kwargs)
+            if dyn_args:
+                values.extend(dyn_args(context, scope))
+            if dyn_kwargs:
+                keywords.update(dyn_kwargs(context, scope))
+            return values, keywords
+        return evaluate
+
+    def visit_Name(self, node):
+        name = node.name
+        def evaluate(context, scope):
+            if name in scope:
+                return scope[name]
+            return context.resolve(name)
+        return evaluate
+
+    def visit_Const(self, node):
+        value = node.value
+        return lambda context, scope: value
+
+    visit_TemplateData = visit_Const
+
+    def visit_Getattr(self, node):
+        obj, attr = self.visit(node.node), node.attr
+        get = self.environment.getattr
+        return lambda context, scope: get(obj(context, scope), attr)
+
+    def visit_Getitem(self, node):
+        obj, arg = self.visit(node.node), self.visit(node.arg)
+        get = self.environment.getitem
+        return lambda context, scope: get(obj(context, scope),
+                                          arg(context, scope))
+
+    def visit_Slice(self, node):
+        parts = [self.visit(part) if part is not None else None for part in
+                 (node.start, node.stop, node.step)]
+        return lambda context, scope: slice(*[
+                part(context, scope) if part is not None else None for
+                part in parts])
+
+    def visit_Call(self, node):
+        func, signature = self.visit(node.node), self.signature(node)
+        def evaluate(context, scope):
+            args, kwargs = signature(context, scope)
+            return context.call(func(context, scope), *args, **kwargs)
+        return evaluate
+
+    def visit_Filter(self, node):
+        func = self.environment.filters.get(node.name)
+        if func is None or node.node is None:
+            raise TypeError("There is no filter named %r." % node.name)
+        value, signature = self.visit(node.node), self.signature(node)
+
+        if getattr(func, "contextfilter", False):
+            first = lambda context: (context,)
+        elif getattr(func, "evalcontextfilter", False):
+            first = lambda context: (context.eval_ctx,)
+        elif getattr(func, "environmentfilter", False):
+            first = lambda context: (context.environment,)
+        else:
+            first = lambda context: ()
+
+        def evaluate(context, scope):
+            args, kwargs = signature(context, scope)
+            return func(*(first(context) + (value(context, scope),) +
+                          tuple(args)), **kwargs)
+        return evaluate
+
+    def visit_Test(self, node):
+        func = self.environment.tests.get(node.name)
+        if func is None:
+            raise TypeError("There is no test named %r." % node.name)
+        value, signature = self.visit(node.node), self.signature(node)
+        def evaluate(context, scope):
+            args, kwargs = signature(context, scope)
+            return func(value(context, scope), *args, **kwargs)
+        return evaluate
+
+    def visit_BinExpr(self, node):
+        func = BINARY_OPERATORS[node.operator]
+        left, right = self.visit(node.left), self.visit(node.right)
+        return lambda context, scope: func(left(context, scope),
+                                           right(context, scope))
+
+    visit_Add = visit_Sub = visit_Mul = visit_Div = visit_FloorDiv = \
+    visit_Pow = visit_Mod = visit_BinExpr
+
+    def visit_And(self, node):
+        left, right = self.visit(node.left), self.visit(node.right)
+        return lambda context, scope: (left(context, scope) and
+                                       right(context, scope))
+
+    def visit_Or(self, node):
+        left, right = self.visit(node.left), self.visit(node.right)
+        return lambda context, scope: (left(context, scope) or
+                                       right(context, scope))
+
+    def visit_UnaryExpr(self, node):
+        func, value = UNARY_OPERATORS[node.operator], self.visit(node.node)
+        return lambda context, scope: func(value(context, scope))
+
+    visit_Not = visit_Pos = visit_Neg = visit_UnaryExpr
+
+    def visit_Compare(self, node):
+        expr = self.visit(node.expr)
+        ops = [(COMPARE_OPERATORS[op.op], self.visit(op.expr)) for op in
+               node.ops]
+        def evaluate(context, scope):
+            value = expr(context, scope)
+            for func, operand in ops:
+                right = operand(context, scope)
+                if not func(value, right):
+                    return False
+                value = right
+            return True
+        return evaluate
+
+    def visit_Concat(self, node):
+        parts = map(self.visit, node.nodes)
+        def evaluate(context, scope):
+            join = (markup_join if context.eval_ctx.autoescape else
+                    unicode_join)
+            return join([part(context, scope) for part in parts])
+        return evaluate
+
+    def visit_CondExpr(self, node):
+        test, expr1 = self.visit(node.test), self.visit(node.expr1)
+        if node.expr2 is not None:
+            expr2 = self.visit(node.expr2)
+        else:
+            undefined = self.environment.undefined
+            expr2 = lambda context, scope: undefined(
+                    "the inline if-expression evaluated to false and no else "
+                    "section was defined.")
+        return lambda context, scope: (expr1(context, scope) if
+                                       test(context, scope) else
+                                       expr2(context, scope))
+
+    def visit_Tuple(self, node):
+        items = map(self.visit, node.items)
+        return lambda context, scope: tuple(item(context, scope) for item in
+                                            items)
+
+    def visit_List(self, node):
+        items = map(self.visit, node.items)
+        return lambda context, scope: [item(context, scope) for item in
+                                       items]
+
+    def visit_Dict(self, node):
+        items = [(self.visit(pair.key), self.visit(pair.value)) for pair in
+                 node.items]
+        return lambda context, scope: dict(
+                (key(context, scope), value(context, scope)) for key, value in
+                items)
+
+    def visit_MarkSafe(self, node):
+        expr = self.visit(node.expr)
+        return lambda context, scope: Markup(expr(context, scope))
+
+    def visit_MarkSafeIfAutoescape(self, node):
+        expr = self.visit(node.expr)
+        return lambda context, scope: (
+                context.eval_ctx.autoescape and Markup or identity)(
+                        expr(context, scope))
+
+
+def assignment_target(node):
+    """
+    Returns the name that an assignment target assigns to, or a list of the
+    targets that a tuple is unpacked into.
+    """
+    if isinstance(node, nodes.Name):
+        return node.name
+    if isinstance(node, (nodes.Tuple, nodes.List)):
+        return map(assignment_target, node.items)
+    raise TypeError("%s can't be assigned to." % type(node).__name__)
+
+
+def assign(target, value, scope):
+    if isinstance(target, list):
+        values = list(value)
+        if len(values) != len(target):
+            raise ValueError("Expected %d values to unpack, not %d." % (
+                    len(target), len(values)))
+        for item, value in zip(target, values):
+            assign(item, value, scope)
+        return
+    scope[target] = value
+
+
+class Interpreter(object):
+    """
+    Extracts the values that a template uses by running its IR. Instances are
+    called like the `root` function of a generated extractor, and have the
+    same attributes.
+    """
+
+    def __init__(self, ir, environment):
+        self.keys = tuple(ir.keys)
+        self.slot_hash = ir.slot_hash
+        self.names = ir.names
+        self.block_keys = dict((name, tuple(keys)) for name, keys in
+                               ir.block_keys.items())
+        self.raw = frozenset(ir.raw)
+        self.shared = ir.shared
+
+        self.expressions = ExpressionCompiler(environment)
+        self.program = []
+        # Only the blocks that are asked for are run. Assignments outside of
+        # blocks are always made, since blocks may read them.
+        for step in ir.body:
+            if isinstance(step, Assign):
+                self.emit_steps([step], self.program)
+                continue
+            skip = len(self.program)
+            self.program.append(None)
+            self.emit_steps([step], self.program)
+            self.program[skip] = (
+                    SKIP_BLOCK, step.name if isinstance(step, Block) else
+                    "__default__", len(self.program))
+        del self.expressions
+
+    def emit_steps(self, steps, program, local=False):
+        """
+        Appends the instructions for a list of steps to `program`. Names that
+        are assigned by `local` steps, which are taken for the items of a
+        loop, are not stored in `context.vars`.
+        """
+        for step in steps:
+            if isinstance(step, Accessor):
+                program.append((EVALUATE, location(step),
+                                self.expressions.visit(step.node),
+                                raw_value if step.key in self.raw else
+                                client_value,
+                                step.loop is None and step.key in self.shared))
+            elif isinstance(step, Assign):
+                program.append((ASSIGN, assignment_target(step.target),
+                                self.expressions.visit(step.node),
+                                () if local else step.names))
+            elif isinstance(step, Conditional):
+                branch = len(program)
+                program.append(None)
+                self.emit_steps(step.body, program, local)
+                if step.else_:
+                    jump = len(program)
+                    program.append(None)
+                    program[branch] = (BRANCH, location(step.test),
+                                       len(program))
+                    self.emit_steps(step.else_, program, local)
+                    program[jump] = (JUMP, len(program))
+                else:
+                    program[branch] = (BRANCH, location(step.test),
+                                       len(program))
+            elif isinstance(step, Loop):
+                # The steps for each item are a program of their own, which
+                # is run once for every item. The loop's `else` steps follow
+                # it, and are skipped if there are items.
+                body = []
+                self.emit_steps(step.body, body, True)
+                test = step.test and self.expressions.visit(step.test)
+                instruction = len(program)
+                program.append(None)
+                self.emit_steps(step.else_, program, local)
+                program[instruction] = (
+                        LOOP, location(step.accessor),
+                        assignment_target(step.target),
+                        self.expressions.visit(step.iter), test, body,
+                        len(step.fields), step.reads_loop, len(program))
+            elif isinstance(step, Block):
+                self.emit_steps(step.steps, program, local)
+
+    def __call__(self, context, environment, blocks=None):
+        self.run(self.program, context, {}, [], blocks)
+
+    def run(self, program, context, scope, records, blocks=None):
+        """
+        Runs a program. `records` holds the entry of the current item of each
+        loop that the program is in.
+        """
+        vars = context.vars
+        end = len(program)
+        position = 0
+        while position < end:
+            instruction = program[position]
+            position += 1
+            op = instruction[0]
+            if op == EVALUATE:
+                depth, slot = instruction[1]
+                # Values that other blocks read are only evaluated once when
+                # every block is extracted.
+                if instruction[4] and blocks is None and slot in vars:
+                    continue
+                value = instruction[2](context, scope)
+                if depth is None:
+                    vars[slot] = value
+                else:
+                    records[depth][slot] = instruction[3](value)
+            elif op == BRANCH:
+                depth, slot = instruction[1]
+                if not (vars[slot] if depth is None else records[depth][slot]):
+                    position = instruction[2]
+            elif op == JUMP:
+                position = instruction[1]
+            elif op == SKIP_BLOCK:
+                if blocks is not None and instruction[1] not in blocks:
+                    position = instruction[2]
+            elif op == ASSIGN:
+                assign(instruction[1], instruction[2](context, scope), scope)
+                for name in instruction[3]:
+                    vars[name] = scope[name]
+            elif op == LOOP:
+                depth, slot = instruction[1]
+                entries = self.loop(instruction, context, scope, records)
+                if depth is None:
+                    vars[slot] = entries
+                else:
+                    records[depth][slot] = entries
+                if entries:
+                    position = instruction[8]
+
+    def loop(self, instruction, context, scope, records):
+        """Builds the entries of a loop's items."""
+        (_, _, target, iterable, test, program, size, reads_loop,
+         _) = instruction
+        # The loop's variables don't outlive it.
+        scope = dict(scope)
+        items = iterable(context, scope)
+        if test is not None:
+            items = [item for item in items if
+                     assign(target, item, scope) or test(context, scope)]
+
+        entries = Entries()
+        records.append(None)
+        if reads_loop:
+            items = LoopContext(items)
+        for item in items:
+            if reads_loop:
+                item, scope["loop"] = item
+            assign(target, item, scope)
+            records[-1] = record = [None] * size
+            entries.append(record)
+            self.run(program, context, scope, records)
+        records.pop()
+        return entries
+
+
+def location(accessor):
+    """Returns the location of an accessor's value."""
+    if accessor.loop is None:
+        return None, accessor.key
+    return accessor.loop.depth, accessor.field
+
+
+def compile_interpreter(environment, template):
+    """
+    Builds the interpreter for the named template from its IR. Returns the
+    interpreter along with the loader's `uptodate` callable.
+    """
+    ir = get_ir(environment, template)
+    return Interpreter(ir, environment), ir.uptodate
@@ -0,0 +1,1332 @@
+"""
+The intermediate representation that both the JS compiler and the JSON
+extractor are generated from. Each template is parsed, optimized, and analyzed
+once; the analysis finds every value that the compiled JS reads from `param`
+and the key that it is read by, so both sides agree on the keys by
+construction.
+"""
+
+from collections import OrderedDict
+from hashlib import sha1
+import json
+import threading
+
+from jinja2 import nodes
+from jinja2.compiler import operators
+from jinja2.exceptions import TemplateNotFound
+from jinja2.filters import FILTERS
+from jinja2.visitor import NodeVisitor
+
+from cache import CompilationCache
+from optimizer import optimize
+
+
+class Accessor(object):
+    """
+    A value that the compiled JS reads from `param` under `key`. Values that
+    depend on the item of a loop are instead read from the item's entry: `loop`
+    is the loop and `field` is the value's position in each entry.
+    """
+
+    def __init__(self, key, node, loop=None, field=None):
+        self.key = key
+        self.node = node
+        self.loop = loop
+        self.field = field
+
+
+class Assign(object):
+    """A `{% set %}` tag, which assigns to the names in `names`."""
+
+    def __init__(self, target, node, names):
+        self.target = target
+        self.node = node
+        self.names = names
+
+
+class Conditional(object):
+    """
+    An `{% if %}` tag. `test` is the accessor for its condition, which has
+    already been evaluated by an earlier step, and `body` and `else_` are the
+    steps of its branches.
+    """
+
+    def __init__(self, test, body, else_):
+        self.test = test
+        self.body = body
+        self.else_ = else_
+
+
+class Loop(object):
+    """
+    A `{% for %}` tag. Rather than the sequence itself, the client is passed a
+    list of entries under the key of `accessor`, one for each item, holding
+    the values of `fields` that the item's body reads. `body` is the list of
+    steps that evaluate those fields for each item, and `else_` is the list of
+    steps that are taken if there are no items.
+
+    `names` are the names that are local to each item, and `depth` is the
+    number of loops that the loop is in.
+    """
+
+    def __init__(self, node, names, depth):
+        self.node = node
+        self.target = node.target
+        self.iter = node.iter
+        self.test = node.test
+        self.names = names
+        self.depth = depth
+        self.accessor = None
+        self.fields = []
+        self.body = []
+        self.else_ = []
+
+    @property
+    def reads_loop(self):
+        """Whether the extractor has to track the `loop` variable."""
+        children = list(self.node.body)
+        if self.test is not None:
+            children.append(self.test)
+        return any(name.name == "loop" for child in children for name in
+                   child.find_all(nodes.Name))
+
+
+class Block(object):
+    """A top-level block, which is compiled to its own function."""
+
+    def __init__(self, name, steps):
+        self.name = name
+        self.steps = steps
+
+
+# The tags that define what a template's blocks, macros, and imports are,
+# rather than output anything where they are.
+DEFINITIONS = (nodes.Block, nodes.Macro, nodes.Import, nodes.FromImport)
+
+
+class TemplateIR(object):
+    """
+    The analyzed form of a template. `body` is the list of steps that the
+    extractor takes, in template order; steps are `Accessor`, `Assign`,
+    `Conditional`, `Loop`, and `Block` objects. Steps outside of any block
+    belong to the `__default__` block.
+    """
+
+    def __init__(self, ast, name=None, filename=None):
+        self.ast = ast
+        self.name = name
+        self.filename = filename
+        # The loader's `uptodate` callable for the template's source.
+        self.uptodate = None
+
+        self.body = []
+        self.blocks = OrderedDict()
+        # Every key that the compiled JS reads, in the order it is first read.
+        self.keys = []
+        self.extends = None
+        self.parent = None
+        # The names of the templates that are extended, included, or imported.
+        self.dependencies = []
+        # The accessor for each expression that the compiled JS reads, and
+        # the loop for each `{% for %}` tag, by the node's id.
+        self.accessors = {}
+        self.loops = {}
+        # The filters that the client applies, by the node's id, as the name
+        # of the runtime's function and the nodes of its arguments. The keys
+        # of the values that they are applied to are in `raw`, since those
+        # values are passed as they are rather than as primitives.
+        self.filters = {}
+        self.raw = set()
+        # The keys that the entries of loops are passed by.
+        self.loop_keys = set()
+        # The IR of each template that is included or imported, by the node's
+        # id. Each is the IR of the whole template (see `get_module_ir`),
+        # whose keys are the arguments of the function it's compiled to.
+        self.includes = {}
+        # The names of the variables that each key's value reads, and the
+        # node that the key was first read from.
+        self.depends = {}
+        self.key_nodes = {}
+
+        # The IR of each macro that the template defines, by name. Each is
+        # analyzed with its parameters as free names, and its keys are the
+        # arguments of the function it's compiled to.
+        self.macros = OrderedDict()
+        # Why each of the other macros that the template defines can't be
+        # compiled, by name. Calling one of them is an error.
+        self.rejected = {}
+        # The templates that the template imports, by the name that they're
+        # imported as, as their IR and the name of the macro that is imported
+        # (or `None` if the whole template is). The macros of the ones in
+        # `contextless` are imported without the context.
+        self.imports = {}
+        self.contextless = set()
+        # Each call of a macro is expanded to a copy of the macro's body, with
+        # the call's arguments in place of the macro's parameters. `calls`
+        # maps the id of the call to the macro's IR and the copy of each of
+        # its nodes, by the original's id. `origins` maps the id of each copy
+        # to the call and the original node, and `expansions` are the copied
+        # bodies.
+        self.calls = {}
+        self.origins = {}
+        self.expansions = []
+
+        self._keys = {}
+        self._slots = None
+
+    @property
+    def slots(self):
+        """
+        Maps each key to its slot in compact payloads. Slot 0 holds the hash
+        of the slot table, so the keys start at slot 1.
+        """
+        if self._slots is None:
+            self._slots = dict((key, slot) for slot, key in
+                               enumerate(self.keys, 1))
+        return self._slots
+
+    @property
+    def slot_hash(self):
+        """
+        A short hash of the slot table, which the JS checks compact payloads
+        against so that a payload built for another version of the template
+        is never read by the wrong slots.
+        """
+        return slot_hash(self.keys)
+
+    @property
+    def names(self):
+        """
+        The names of every variable that the template reads. Names that are
+        assigned by the template are included too, since they may be read
+        before they are assigned.
+        """
+        return frozenset(node.name for ir in self.templates() for node in
+                         ir.ast.find_all(nodes.Name) if node.ctx == "load")
+
+    @property
+    def block_keys(self):
+        """
+        Maps the name of each block to the keys that its function reads, in
+        the order it first reads them.
+        """
+        return OrderedDict((name, step_keys(block.steps)) for name, block in
+                           self.blocks.items())
+
+    @property
+    def shared(self):
+        """
+        The keys that more than one block reads and that don't read any name
+        that the template assigns. When every block is extracted, these are
+        evaluated by the first block that reads them, and reused by the rest.
+        """
+        assigned = set()
+        pending = list(self.body)
+        while pending:
+            step = pending.pop()
+            if isinstance(step, Assign):
+                assigned.update(step.names)
+            elif isinstance(step, Conditional):
+                pending.extend(step.body + step.else_)
+            elif isinstance(step, Loop):
+                pending.extend(step.body + step.else_)
+            elif isinstance(step, Block):
+                pending.extend(step.steps)
+
+        readers = {}
+        for keys in self.block_keys.values():
+            for key in keys:
+                readers[key] = readers.get(key, 0) + 1
+        return frozenset(key for key, count in readers.items() if
+                         count > 1 and self.depends[key].isdisjoint(assigned))
+
+    @property
+    def outputs_default(self):
+        """
+        Whether the compiled JS has a `__default__` block function, which it
+        has if anything other than output, blocks, macros, and imports is
+        outside of its blocks. Templates that extend another inherit the
+        other's.
+        """
+        if self.parent is not None:
+            return self.parent.outputs_default
+        return any(not isinstance(node, DEFINITIONS + (nodes.Output,)) for
+                   node in self.ast.body)
+
+    def key(self, node):
+        """Returns the key that the value of an expression is passed by."""
+        key = self._keys.get(id(node))
+        if key is None:
+            key = self._keys[id(node)] = accessor_key(node)
+        return key
+
+    def templates(self):
+        """
+        Returns the IR of the template along with the IRs of every template
+        that it extends or includes, directly or through other templates.
+        """
+        found = [self]
+        for ir in found:
+            for other in [ir.parent] + ir.includes.values():
+                if other is not None and other not in found:
+                    found.append(other)
+        return found
+
+    def statements(self):
+        """
+        Returns every statement node in the template, including the contents
+        of its blocks and of the templates that it extends or includes.
+        """
+        body = []
+        for ir in self.templates():
+            body.extend(ir.ast.body)
+            body.extend(ir.expansions)
+            found = [node for tree in [ir.ast] + ir.expansions for node in
+                     [tree] + list(tree.find_all((nodes.Block, nodes.For)))]
+            for node in found:
+                if isinstance(node, nodes.Block):
+                    body.extend(node.body)
+                elif isinstance(node, nodes.For):
+                    body.append(node.target)
+                    body.extend(node.body)
+                    body.extend(node.else_)
+                    if node.test is not None:
+                        body.append(node.test)
+        return body
+
+    def modules(self):
+        """
+        Returns the IRs of every template that the template or its macros
+        include or import, directly or through other templates.
+        """
+        found = []
+        pending = [self]
+        while pending:
+            ir = pending.pop(0)
+            pending.extend(ir.macros.values())
+            for module in ir.includes.values():
+                if module not in found:
+                    found.append(module)
+                    pending.append(module)
+        return found
+
+
+def step_keys(steps, keys=None):
+    """Returns the keys of the accessors in a list of steps, in order."""
+    if keys is None:
+        keys = []
+    for step in steps:
+        if isinstance(step, Accessor):
+            if step.loop is None and step.key not in keys:
+                keys.append(step.key)
+        elif isinstance(step, Conditional):
+            step_keys([step.test], keys)
+            step_keys(step.body, keys)
+            step_keys(step.else_, keys)
+        elif isinstance(step, Loop):
+            step_keys([step.accessor], keys)
+            step_keys(step.body, keys)
+            step_keys(step.else_, keys)
+        elif isinstance(step, Block):
+            step_keys(step.steps, keys)
+    return keys
+
+
+def slot_hash(keys):
+    """Returns the hash of a slot table made of `keys`."""
+    return sha1(json.dumps(list(keys))).hexdigest()[:8]
+
+
+def accessor_key(node):
+    """Returns the key that the value of an expression is passed by."""
+    return KeyVisitor().visit(node)
+
+
+class KeyVisitor(NodeVisitor):
+    """Renders expressions as the Python-like source that keys are made of."""
+
+    def generic_visit(self, node):
+        raise TypeError("%s expressions can't be passed to the client." %
+                        type(node).__name__)
+
+    def visit_Name(self, node):
+        return node.name
+
+    def visit_Const(self, node):
+        if isinstance(node.value, basestring):
+            return u"'%s'" % node.value
+        return unicode(node.value)
+
+    def visit_Getattr(self, node):
+        return u"%s.%s" % (self.visit(node.node), node.attr)
+
+    def visit_Getitem(self, node):
+        return u"%s[%s]" % (self.visit(node.node), self.visit(node.arg))
+
+    def visit_Slice(self, node):
+        parts = [self.visit(part) if part is not None else u"" for part in
+                 (node.start, node.stop)]
+        if node.step is not None:
+            parts.append(self.visit(node.step))
+        return u":".join(parts)
+
+    def signature(self, node):
+        args = [self.visit(arg) for arg in node.args]
+        args.extend(self.visit(kwarg) for kwarg in node.kwargs)
+        if node.dyn_args is not None:
+            args.append(u"*" + self.visit(node.dyn_args))
+        if node.dyn_kwargs is not None:
+            args.append(u"**" + self.visit(node.dyn_kwargs))
+        return u", ".join(args)
+
+    def visit_Call(self, node):
+        return u"%s(%s)" % (self.visit(node.node), self.signature(node))
+
+    def visit_Keyword(self, node):
+        return u"%s=%s" % (node.key, self.visit(node.value))
+
+    def visit_Filter(self, node):
+        key = u"%s|%s" % (self.visit(node.node), node.name)
+        if node.args or node.kwargs or node.dyn_args or node.dyn_kwargs:
+            key += u"(%s)" % self.signature(node)
+        return key
+
+    def visit_Test(self, node):
+        key = u"%s is %s" % (self.visit(node.node), node.name)
+        if node.args or node.kwargs or node.dyn_args or node.dyn_kwargs:
+            key += u"(%s)" % self.signature(node)
+        return key
+
+    def visit_BinExpr(self, node):
+        return u"(%s %s %s)" % (self.visit(node.left), node.operator,
+                                self.visit(node.right))
+
+    visit_And = visit_Or = visit_Add = visit_Sub = visit_Mul = visit_Div = \
+    visit_FloorDiv = visit_Pow = visit_Mod = visit_BinExpr
+
+    def visit_Not(self, node):
+        return u"(not %s)" % self.visit(node.node)
+
+    def visit_Pos(self, node):
+        return u"(%s%s)" % (node.operator, self.visit(node.node))
+
+    visit_Neg = visit_Pos
+
+    def visit_Compare(self, node):
+        key = [self.visit(node.expr)]
+        for op in node.ops:
+            key.append(u"%s %s" % (operators[op.op], self.visit(op.expr)))
+        return u"(%s)" % u" ".join(key)
+
+    def visit_Concat(self, node):
+        return u"(%s)" % u" ~ ".join(map(self.visit, node.nodes))
+
+    def visit_CondExpr(self, node):
+        return u"(%s if %s else %s)" % (
+                self.visit(node.expr1), self.visit(node.test),
+                self.visit(node.expr2) if node.expr2 is not None else u"None")
+
+    def visit_Tuple(self, node):
+        if len(node.items) == 1:
+            return u"(%s,)" % self.visit(node.items[0])
+        return u"(%s)" % u", ".join(map(self.visit, node.items))
+
+    def visit_List(self, node):
+        return u"[%s]" % u", ".join(map(self.visit, node.items))
+
+    def visit_Dict(self, node):
+        return u"{%s}" % u", ".join(u"%s: %s" % (self.visit(pair.key),
+                                                 self.visit(pair.value)) for
+                                    pair in node.items)
+
+
+def node_names(node):
+    """Returns the names that an expression reads or a target assigns to."""
+    names = [name.name for name in node.find_all(nodes.Name)]
+    if isinstance(node, nodes.Name):
+        names.insert(0, node.name)
+    return names
+
+
+# The attributes of `loop` that the compiled JS computes itself.
+LOOP_HELPERS = ("index", "index0", "revindex", "revindex0", "first", "last",
+                "length")
+
+
+def loop_helper(node):
+    """
+    Returns the attribute of `loop` that an expression reads if the compiled
+    JS computes it, or `None`.
+    """
+    if (isinstance(node, nodes.Getattr) and node.attr in LOOP_HELPERS and
+        isinstance(node.node, nodes.Name) and node.node.name == "loop"):
+        return node.attr
+    return None
+
+
+def is_loop_cycle(node):
+    """Returns whether a call is a `loop.cycle(...)`."""
+    return (isinstance(node.node, nodes.Getattr) and
+            node.node.attr == "cycle" and
+            isinstance(node.node.node, nodes.Name) and
+            node.node.node.name == "loop" and not node.kwargs and
+            node.dyn_args is None and node.dyn_kwargs is None and
+            bool(node.args))
+
+
+# The filters that the JS runtime implements, by their name in templates, as
+# the name of the runtime's function and the names of its parameters after the
+# filtered value. `escape` isn't among them, since values that are already
+# safe, such as `Markup`, would be escaped twice. `length` is only applied on
+# the client to values that are sent as they are anyway (see
+# `IRBuilder.visit_Filter`), since the number is smaller than the value that
+# it counts.
+CLIENT_FILTERS = {
+    "length": ("length", ()),
+    "count": ("length", ()),
+    "default": ("default_", ("default_value", "boolean")),
+    "d": ("default_", ("default_value", "boolean")),
+    "join": ("join", ("d",)),
+    "upper": ("upper", ()),
+    "lower": ("lower", ()),
+    "truncate": ("truncate", ("length", "killwords", "end")),
+}
+
+
+def client_filter(node, environment=None):
+    """
+    Returns the name of the runtime's function for a filter that the client
+    can apply, along with the nodes of its arguments in order (`None` for the
+    ones that are left out), or `None` if the filter is applied on the server.
+    Filters that the environment replaced are always applied on the server.
+    """
+    if (node.name not in CLIENT_FILTERS or node.node is None or
+        node.dyn_args is not None or node.dyn_kwargs is not None):
+        return None
+    if (environment is not None and
+        environment.filters.get(node.name) is not FILTERS[node.name]):
+        return None
+
+    function, params = CLIENT_FILTERS[node.name]
+    if len(node.args) > len(params):
+        return None
+    args = list(node.args) + [None] * (len(params) - len(node.args))
+    for kwarg in node.kwargs:
+        if kwarg.key not in params:
+            return None
+        position = params.index(kwarg.key)
+        if args[position] is not None:
+            return None
+        args[position] = kwarg.value
+    while args and args[-1] is None:
+        args.pop()
+    return function, args
+
+
+def filtered_keys(ast, environment=None):
+    """
+    Returns the keys of the values in a template that the client applies
+    filters other than `length` to, which are passed as they are.
+    """
+    keys = set()
+    for node in ast.find_all(nodes.Filter):
+        filter = client_filter(node, environment)
+        if filter is None or filter[0] == "length":
+            continue
+        try:
+            keys.add(accessor_key(node.node))
+        except TypeError:
+            pass
+    return keys
+
+
+def is_super(node):
+    """Returns whether a call is a `super()`."""
+    return (isinstance(node.node, nodes.Name) and node.node.name == "super" and
+            not node.args and not node.kwargs)
+
+
+def extended_template(ast):
+    """
+    Returns the name of the template that a template always extends, or
+    `None` if it doesn't extend one or the one that it extends is chosen at
+    runtime.
+    """
+    for node in ast.body:
+        if isinstance(node, nodes.Extends):
+            if isinstance(node.template, nodes.Const):
+                return node.template.value
+            return None
+    return None
+
+
+def macro_params(macro):
+    """
+    Returns the names of a macro's parameters, or `None` if calls of the
+    macro can't be expanded: if it reads `varargs`, `kwargs`, or `caller`,
+    or assigns to one of its parameters.
+    """
+    params = [arg.name for arg in macro.args]
+    for child in macro.body:
+        for node in child.find_all(nodes.Name):
+            if node.name in ("varargs", "kwargs", "caller"):
+                return None
+            if node.ctx != "load" and node.name in params:
+                return None
+        if (isinstance(child, (nodes.Macro, nodes.CallBlock)) or
+            next(child.find_all((nodes.Macro, nodes.CallBlock)), None)):
+            return None
+    return params
+
+
+def bind(node, macro):
+    """
+    Returns the node of the value of each of a macro's parameters, by name,
+    for a call of the macro, or `None` if the call can't be expanded.
+    """
+    params = macro_params(macro)
+    if (params is None or node.dyn_args is not None or
+        node.dyn_kwargs is not None or len(node.args) > len(params)):
+        return None
+    bindings = dict(zip(params, node.args))
+    for kwarg in node.kwargs:
+        if kwarg.key not in params or kwarg.key in bindings:
+            return None
+        bindings[kwarg.key] = kwarg.value
+    # The defaults are for the last parameters.
+    defaults = dict(zip(params[len(params) - len(macro.defaults):],
+                        macro.defaults))
+    for param in params:
+        if param not in bindings:
+            if param not in defaults:
+                return None
+            bindings[param] = defaults[param]
+    return bindings
+
+
+def free_names(macro, scope, environment=None):
+    """
+    Returns the names that a macro reads from the context it is rendered in:
+    the names that it doesn't assign, and that aren't the names of macros,
+    imports, or globals.
+    """
+    assigned = set(node.name for node in macro.find_all(nodes.Name) if
+                   node.ctx != "load")
+    assigned.update(arg.name for arg in macro.args)
+    assigned.update(scope.macros, scope.rejected, scope.imports)
+    assigned.update(("loop", "_"))
+    if environment is not None:
+        assigned.update(environment.globals)
+    return set(node.name for node in macro.find_all(nodes.Name) if
+               node.name not in assigned)
+
+
+def printed_names(macro):
+    """Returns the names that a macro only reads to output them."""
+    printed = set(id(child) for output in macro.find_all(nodes.Output) for
+                  child in output.nodes if isinstance(child, nodes.Name))
+    names = set(node.name for node in macro.find_all(nodes.Name) if
+                id(node) in printed)
+    return names - set(node.name for node in macro.find_all(nodes.Name) if
+                       id(node) not in printed)
+
+
+def substitute(node, bindings, call, ir):
+    """
+    Returns a copy of a node in which the names in `bindings` are replaced by
+    their nodes, recording each copy as an expansion of `call` in `ir`.
+    Returns the copies of the nodes by their original's id too.
+    """
+    copies = {}
+
+    def copy(node):
+        if (isinstance(node, nodes.Name) and node.ctx == "load" and
+            node.name in bindings):
+            copies[id(node)] = bindings[node.name]
+            return bindings[node.name]
+        clone = object.__new__(type(node))
+        for attr in node.attributes:
+            setattr(clone, attr, getattr(node, attr, None))
+        for field, value in node.iter_fields():
+            if isinstance(value, list):
+                value = [copy(item) if isinstance(item, nodes.Node) else item
+                         for item in value]
+            elif isinstance(value, nodes.Node):
+                value = copy(value)
+            setattr(clone, field, value)
+        copies[id(node)] = clone
+        ir.origins[id(clone)] = (call, node)
+        return clone
+
+    return copy(node), copies
+
+
+def is_gettext(node):
+    """Returns whether a call is a `_('...')` that the client translates."""
+    return (isinstance(node.node, nodes.Name) and node.node.name == "_" and
+            len(node.args) == 1 and isinstance(node.args[0], nodes.Const))
+
+
+class IRBuilder(NodeVisitor):
+    """
+    Builds the steps of a `TemplateIR`. The statement visitors return lists of
+    steps, and the expression visitors return the accessors for the values
+    that the compiled JS reads while evaluating the expression.
+    """
+
+    def __init__(self, ir, environment=None, scope=None):
+        self.ir = ir
+        # The environment that the template is rendered by, if it is known.
+        self.environment = environment
+        # The IR of the template whose macros and imports the names of the
+        # macros that are called are looked up in, and the macros whose calls
+        # are being expanded.
+        self.scope = ir if scope is None else scope
+        self.expanding = []
+        # Whether the macros that are being expanded were imported without
+        # the context.
+        self.contextless = False
+        self.seen = set()
+        # The keys of the accessors that are certain to have been evaluated
+        # by the steps before the current one, and that no assignment has
+        # changed since. These aren't evaluated again.
+        self.evaluated = set()
+        # The names of the variables that each accessor reads, by key.
+        self.depends = ir.depends
+        # The loops that the current step is in, outermost first, and the
+        # steps that are taken before each of them. Values that a loop's body
+        # reads but that don't depend on its items are evaluated once, before
+        # the loop, instead of for every item.
+        self.loops = []
+        self.hoisted = []
+        # The top-level block that is being built, and the blocks that call
+        # `super()`.
+        self.block = None
+        self.supers = set()
+        # The keys of the values that the template's client filters are
+        # applied to.
+        self.filtered = filtered_keys(ir.ast, environment)
+
+    def build(self):
+        self.define()
+        parent = self.ir.parent
+        if parent is not None:
+            # The parent's keys come first, so that the JS it was compiled to
+            # reads the same slots of compact payloads as the child's does.
+            self.ir.keys.extend(parent.keys)
+            self.seen.update(parent.keys)
+            self.ir.loop_keys.update(parent.loop_keys)
+            self.ir.raw.update(parent.raw)
+
+        # Each block can be extracted on its own, so they start with nothing
+        # evaluated. Steps outside of blocks are all part of `__default__`.
+        default = set()
+        for node in self.ir.ast.body:
+            # Output outside of blocks is not compiled to JS.
+            if isinstance(node, nodes.Output):
+                continue
+            if isinstance(node, nodes.Block):
+                self.evaluated = set()
+                self.block = node.name
+                block = Block(node.name, self.statements(node.body))
+                self.block = None
+                if node.name in self.supers:
+                    block.steps.append(parent.blocks[node.name])
+                self.ir.blocks[node.name] = block
+                self.ir.body.append(block)
+                continue
+            self.evaluated = default
+            self.ir.body.extend(self.visit(node))
+
+        if parent is not None:
+            self.inherit(parent)
+            return
+        self.ir.blocks["__default__"] = Block(
+                "__default__", [step for step in self.ir.body if
+                                not isinstance(step, Block)])
+
+    def build_module(self):
+        """
+        Builds the IR of a template that is included, or of a macro.
+        Everything that it outputs is rendered, including the output outside
+        of its blocks.
+        """
+        if self.scope is self.ir:
+            self.define()
+        self.ir.body = self.statements(self.ir.ast.body)
+        self.ir.blocks["__default__"] = Block("__default__", self.ir.body)
+
+    def define(self):
+        """
+        Finds the templates that the template imports, and builds the IR of
+        each macro that it defines.
+        """
+        for node in self.ir.ast.find_all((nodes.Import, nodes.FromImport)):
+            module = self.load(node)
+            if module is None:
+                continue
+            self.ir.includes[id(node)] = module
+            if isinstance(node, nodes.Import):
+                aliases = [node.target]
+                self.ir.imports[node.target] = (module, None)
+            else:
+                aliases = []
+                for name in node.names:
+                    name, alias = (name if isinstance(name, tuple) else
+                                   (name, name))
+                    aliases.append(alias)
+                    self.ir.imports[alias] = (module, name)
+            if not node.with_context:
+                self.ir.contextless.update(aliases)
+
+        for node in self.ir.ast.find_all(nodes.Macro):
+            if macro_params(node) is None:
+                self.ir.rejected[node.name] = (
+                        "The macro %r reads varargs, kwargs, or caller, or "
+                        "assigns to its arguments, so it can't be compiled "
+                        "to JS." % node.name)
+                continue
+            self.ir.macros[node.name] = TemplateIR(node, self.ir.name,
+                                                   self.ir.filename)
+        for name, macro in self.ir.macros.items():
+            builder = IRBuilder(macro, self.environment, self.ir)
+            builder.expanding.append(macro)
+            try:
+                builder.build_module()
+            except TypeError, exc:
+                # Macros that call themselves, for instance. Calling them is
+                # an error, but templates may still import their other
+                # macros.
+                del self.ir.macros[name]
+                self.ir.rejected[name] = str(exc)
+
+    def load(self, node):
+        """
+        Returns the IR of the template that an include or import names, as
+        it is included, or `None` if it isn't passed to the client.
+        """
+        # Templates that are included without the context, or that are chosen
+        # at runtime, are not passed to the client.
+        if (self.environment is None or
+            self.environment.loader is None or
+            not isinstance(node.template, nodes.Const) or
+            not isinstance(node.template.value, basestring) or
+            isinstance(node, nodes.Include) and not node.with_context):
+            return None
+        try:
+            return resolve(self.environment, node.template.value,
+                           self.ir.name, get_module_ir)
+        except TemplateNotFound:
+            if getattr(node, "ignore_missing", False):
+                return None
+            raise
+
+    def macro(self, node):
+        """
+        Returns the IR of the macro that a call calls, the IR of the template
+        that defines it, and whether it was imported without the context, or
+        `None` if it doesn't call a macro that is known. Calls of macros that
+        can't be compiled are an error, since the extractor doesn't define
+        any macros.
+        """
+        callee = node.node
+        if isinstance(callee, nodes.Name):
+            macro = self.scope.macros.get(callee.name)
+            if macro is not None:
+                return macro, self.scope, False
+            if callee.name in self.scope.rejected:
+                raise TypeError(self.scope.rejected[callee.name])
+            alias = callee.name
+            module, name = self.scope.imports.get(alias, (None, None))
+        elif (isinstance(callee, nodes.Getattr) and
+              isinstance(callee.node, nodes.Name)):
+            alias = callee.node.name
+            module, name = self.scope.imports.get(alias, (None, None))
+            if name is not None:
+                return None
+            name = callee.attr
+        else:
+            return None
+        if module is not None and name in module.rejected:
+            raise TypeError(module.rejected[name])
+        if module is None or name not in module.macros:
+            return None
+        return module.macros[name], module, alias in self.scope.contextless
+
+    def inherit(self, parent):
+        """
+        Flattens the IR of a template that extends `parent`. Blocks that the
+        template doesn't override are the parent's, and so is `__default__`,
+        since nothing outside of a child's blocks is output.
+        """
+        own = self.ir.blocks
+        # The child's assignments are made before the parent is rendered.
+        body = [step for step in self.ir.body if isinstance(step, Assign)]
+        for step in parent.body:
+            if isinstance(step, Block) and step.name in own:
+                step = own[step.name]
+            body.append(step)
+        body.extend(block for name, block in own.items() if
+                    name not in parent.blocks)
+
+        blocks = OrderedDict((name, own.get(name, block)) for name, block in
+                             parent.blocks.items())
+        for name, block in own.items():
+            blocks.setdefault(name, block)
+        self.ir.body = body
+        self.ir.blocks = blocks
+
+    def generic_visit(self, node):
+        # Features that are not supported are not passed to the client.
+        return []
+
+    def statements(self, nodes):
+        steps = []
+        for node in nodes:
+            steps.extend(self.visit(node))
+        return steps
+
+    def owner(self, names):
+        """
+        Returns the innermost loop whose items a value that reads `names`
+        depends on, or `None` if it doesn't depend on any.
+        """
+        for loop in reversed(self.loops):
+            if not loop.names.isdisjoint(names):
+                return loop
+        return None
+
+    def register(self, key, node, names, loop):
+        """
+        Registers the key of a value as a key of the template, or as a field
+        of the entries of `loop`.
+        """
+        self.depends[key] = names
+        if loop is None:
+            if key not in self.seen:
+                self.seen.add(key)
+                self.ir.keys.append(key)
+                self.ir.key_nodes[key] = node
+            accessor = Accessor(key, node)
+        else:
+            if key not in loop.fields:
+                loop.fields.append(key)
+            accessor = Accessor(key, node, loop, loop.fields.index(key))
+        self.ir.accessors[id(node)] = accessor
+        return accessor
+
+    def accessor(self, node):
+        key = self.ir.key(node)
+        names = self.depends.get(key)
+        if names is None:
+            names = set(node_names(node))
+        return self.register(key, node, names, self.owner(names))
+
+    def evaluate(self, node):
+        """
+        Returns the steps that evaluate an accessor, which are none if it has
+        already been evaluated or is evaluated before the current loop.
+        """
+        accessor = self.accessor(node)
+        if accessor.key in self.evaluated:
+            return []
+        self.evaluated.add(accessor.key)
+        if self.loops and accessor.loop is not self.loops[-1]:
+            level = (0 if accessor.loop is None else
+                     self.loops.index(accessor.loop) + 1)
+            hoisted = self.hoisted[level]
+            if not any(step.key == accessor.key for step in hoisted):
+                hoisted.append(accessor)
+            return []
+        return [accessor]
+
+    def branch(self, nodes, evaluated):
+        """
+        Returns the steps of a branch, which starts with the accessors in
+        `evaluated` evaluated, along with the accessors that are evaluated
+        once it is taken.
+        """
+        self.evaluated = set(evaluated)
+        steps = self.statements(nodes)
+        return steps, self.evaluated
+
+    def add_dependency(self, template):
+        # Templates that are chosen at runtime can't be tracked.
+        if not isinstance(template, nodes.Const):
+            return
+        if template.value not in self.ir.dependencies:
+            self.ir.dependencies.append(template.value)
+
+    # Statements
+
+    def visit_Output(self, node):
+        return self.statements(node.nodes)
+
+    def visit_Block(self, node):
+        # Blocks inside of other blocks are compiled inline.
+        return self.statements(node.body)
+
+    def visit_If(self, node):
+        if self.loops and loop_helper(node.test):
+            # The client decides which branch to take, so the values that
+            # either branch reads are extracted.
+            return self.statements(node.body) + self.statements(node.else_)
+
+        if isinstance(node.test, nodes.Const):
+            # Macros that are passed constants test them. Only the branch
+            # that is taken is extracted, and the constant isn't passed.
+            return self.statements(node.body if node.test.value else
+                                   node.else_)
+
+        steps = self.evaluate(node.test)
+        evaluated = self.evaluated
+        body, body_evaluated = self.branch(node.body, evaluated)
+        else_, else_evaluated = self.branch(node.else_, evaluated)
+        # Only what both branches evaluate is certain to be evaluated after
+        # the conditional.
+        self.evaluated = evaluated
+        evaluated.clear()
+        evaluated.update(body_evaluated & else_evaluated)
+
+        steps.append(Conditional(self.accessor(node.test), body, else_))
+        return steps
+
+    def visit_Assign(self, node):
+        names = node_names(node.target)
+        steps = [Assign(node.target, node.node, names)]
+        # Values that read the names that were assigned have to be evaluated
+        # again.
+        for key in list(self.evaluated):
+            if not self.depends[key].isdisjoint(names):
+                self.evaluated.discard(key)
+        return steps
+
+    def visit_For(self, node):
+        if node.recursive:
+            raise TypeError("Recursive loops can't be compiled to JS.")
+
+        if isinstance(node.iter, nodes.Const) and node.iter.value is None:
+            # Undefined values, such as the names that macros imported
+            # without the context read, have no items.
+            return self.statements(node.else_)
+
+        # Each item has its own loop variables, along with its own copy of
+        # the names that are assigned in the loop's body.
+        names = set(node_names(node.target))
+        names.add("loop")
+        for child in node.body:
+            assigns = list(child.find_all(nodes.Assign))
+            if isinstance(child, nodes.Assign):
+                assigns.append(child)
+            for assign in assigns:
+                names.update(node_names(assign.target))
+        loop = Loop(node, names, len(self.loops))
+        self.ir.loops[id(node)] = loop
+
+        evaluated = self.evaluated
+        self.evaluated = set(key for key in evaluated if
+                             self.depends[key].isdisjoint(names))
+        self.loops.append(loop)
+        self.hoisted.append([])
+        loop.body = self.statements(node.body)
+        steps = self.hoisted.pop()
+        self.loops.pop()
+
+        # The key names the fields of the entries, so that the same loop has
+        # the same key in every template that includes it. Loops inside of
+        # other loops have their entries built for each item of the outer
+        # loop.
+        key = u"for %s in %s" % (accessor_key(node.target),
+                                 self.ir.key(node.iter))
+        if node.test is not None:
+            key += u" if %s" % accessor_key(node.test)
+        key += u" [%s]" % u", ".join(loop.fields)
+        self.ir.loop_keys.add(key)
+        depends = set(node_names(node.iter))
+        if node.test is not None:
+            depends.update(set(node_names(node.test)) - names)
+        loop.accessor = self.register(
+                key, node.iter, depends,
+                self.loops[-1] if self.loops else self.owner(depends))
+
+        self.evaluated = evaluated
+        evaluated.update(step.key for step in steps)
+        loop.else_, _ = self.branch(node.else_, evaluated)
+        self.evaluated = evaluated
+
+        steps.append(loop)
+        return steps
+
+    def visit_ExprStmt(self, node):
+        return self.visit(node.node)
+
+    def visit_Extends(self, node):
+        if isinstance(node.template, nodes.Const):
+            self.ir.extends = node.template.value
+        self.add_dependency(node.template)
+        return []
+
+    def visit_Include(self, node):
+        self.add_dependency(node.template)
+        module = self.load(node)
+        if module is None:
+            return []
+        self.ir.includes[id(node)] = module
+        self.ir.loop_keys.update(module.loop_keys)
+        # The values that the included template reads are extracted along
+        # with the template's own, where it includes it.
+        return self.statements(module.ast.body)
+
+    def visit_Import(self, node):
+        self.add_dependency(node.template)
+        return []
+
+    visit_FromImport = visit_Import
+
+    # Expressions
+
+    def visit_value(self, node):
+        if self.loops and loop_helper(node):
+            return []
+        return self.evaluate(node)
+
+    visit_Name = visit_Getattr = visit_Getitem = visit_Test = \
+    visit_Keyword = visit_value
+
+    def is_raw(self, node):
+        """Returns whether the value of an expression is passed as it is."""
+        try:
+            key = self.ir.key(node)
+        except TypeError:
+            return False
+        return key in self.ir.raw or key in self.filtered
+
+    def visit_Filter(self, node):
+        filter = client_filter(node, self.environment)
+        if (filter is not None and filter[0] == "length" and
+            not self.is_raw(node.node)):
+            # Only the length is passed, unless the value is passed anyway.
+            filter = None
+        if filter is None:
+            return self.evaluate(node)
+        self.ir.filters[id(node)] = filter
+
+        steps = self.visit(node.node)
+        # The value is filtered on the client, so it's passed as it is.
+        accessor = self.ir.accessors.get(id(node.node))
+        if accessor is not None:
+            self.ir.raw.add(accessor.key)
+        return steps + self.statements([arg for arg in filter[1] if
+                                        arg is not None])
+
+    def visit_Call(self, node):
+        if is_gettext(node):
+            return []
+        found = self.macro(node)
+        if found is not None:
+            return self.expand(node, *found)
+        parent = self.ir.parent
+        if (is_super(node) and parent is not None and
+            self.block in parent.blocks):
+            # The client renders the parent's block, so the values that it
+            # reads are extracted along with the block's own.
+            self.supers.add(self.block)
+            return []
+        if self.loops and is_loop_cycle(node):
+            return self.statements(node.args)
+        return self.evaluate(node)
+
+    def expand(self, node, macro, scope, contextless=False):
+        """
+        Returns the steps of a call of a macro, which are the steps of a copy
+        of the macro's body with the call's arguments in place of its
+        parameters, so that the values that the macro reads are extracted for
+        each call. The names that macros imported without the context read
+        from it are undefined: they're output as nothing, and are passed to
+        the client as `null` otherwise.
+        """
+        name = macro.ast.name
+        bindings = bind(node, macro.ast)
+        if bindings is None:
+            raise TypeError("The call of the macro %r can't be compiled to JS."
+                            % name)
+        if macro in self.expanding:
+            raise TypeError("The macro %r calls itself." % name)
+        if contextless or self.contextless:
+            printed = printed_names(macro.ast)
+            for free in free_names(macro.ast, scope, self.environment):
+                bindings[free] = nodes.Const(u"" if free in printed else None,
+                                             lineno=node.lineno)
+
+        body = []
+        copies = {}
+        for child in macro.ast.body:
+            child, child_copies = substitute(child, bindings, node, self.ir)
+            body.append(child)
+            copies.update(child_copies)
+        self.ir.calls[id(node)] = (macro, copies)
+        self.ir.expansions.extend(body)
+
+        # Names in the macro's body are looked up where it is defined.
+        saved = self.scope, self.contextless
+        self.scope = scope
+        self.contextless = contextless or self.contextless
+        self.expanding.append(macro)
+        try:
+            return self.statements(body)
+        finally:
+            self.expanding.pop()
+            self.scope, self.contextless = saved
+
+    def visit_Const(self, node):
+        return []
+
+    visit_TemplateData = visit_Const
+
+    def visit_BinExpr(self, node):
+        return self.visit(node.left) + self.visit(node.right)
+
+    visit_And = visit_Or = visit_Add = visit_Sub = visit_Mul = visit_Div = \
+    visit_FloorDiv = visit_Pow = visit_Mod = visit_BinExpr
+
+    def visit_UnaryExpr(self, node):
+        return self.visit(node.node)
+
+    visit_Not = visit_Pos = visit_Neg = visit_UnaryExpr
+
+    def visit_Compare(self, node):
+        return self.statements([node.expr] + [op.expr for op in node.ops])
+
+    def visit_Concat(self, node):
+        return self.statements(node.nodes)
+
+    def visit_CondExpr(self, node):
+        return self.statements([child for child in
+                                (node.test, node.expr1, node.expr2) if
+                                child is not None])
+
+    def visit_Tuple(self, node):
+        return self.statements(node.items)
+
+    visit_List = visit_Tuple
+
+    def visit_Dict(self, node):
+        return self.statements([part for pair in node.items for part in
+                                (pair.key, pair.value)])
+
+
+def analyze(ast, name=None, filename=None, environment=None, parent=None):
+    """
+    Builds the IR for a parsed template. If `environment` is given, filters
+    that it replaced are applied on the server. If `parent` is given, it is
+    the IR of the template that the template extends, which it's flattened
+    with.
+    """
+    ir = TemplateIR(ast, name, filename)
+    ir.parent = parent
+    IRBuilder(ir, environment).build()
+    return ir
+
+
+# The names of the templates whose parents and includes are being resolved by
+# each thread, so that templates that extend or include themselves are caught.
+resolving = threading.local()
+
+
+def resolve(environment, template, name, get=None):
+    """
+    Returns the IR of a template that the template `name` extends or
+    includes, as `get` (`get_ir` by default) returns it.
+    """
+    chain = getattr(resolving, "chain", None)
+    if chain is None:
+        chain = resolving.chain = []
+    if template == name or template in chain:
+        raise TypeError("The template %r extends or includes itself." %
+                        template)
+    chain.append(name)
+    try:
+        return (get or get_ir)(environment, template)
+    finally:
+        chain.pop()
+
+
+def parse(environment, source, name=None, filename=None, optimized=True):
+    """
+    Parses a template's source, optimizing it unless `optimized` is false.
+    """
+    ast = environment.parse(source, name, filename)
+    if optimized:
+        ast = optimize(ast, environment)
+    return ast
+
+
+def build_ir(environment, source, name=None, filename=None, optimized=True):
+    """
+    Parses a template's source, optimizes it unless `optimized` is false, and
+    builds its IR. If the template extends another and the environment has a
+    loader, the IR of the template that it extends is built (or taken from
+    `irs`) and the template's IR is flattened with it.
+    """
+    ast = parse(environment, source, name, filename, optimized)
+    parent = None
+    extends = extended_template(ast)
+    if extends is not None and environment.loader is not None:
+        parent = resolve(environment, extends, name)
+    return analyze(ast, name, filename, environment, parent)
+
+
+def set_uptodate(ir, uptodate):
+    """
+    Sets the `uptodate` callable of an IR, which is out of date once the
+    template or any template that it extends or includes changes.
+    """
+    checks = [uptodate] + [other.uptodate for other in
+                           [ir.parent] + ir.includes.values() if
+                           other is not None]
+    checks = [check for check in checks if check is not None]
+    if len(checks) > 1:
+        ir.uptodate = lambda: all(check() for check in checks)
+    else:
+        ir.uptodate = uptodate
+    return ir.uptodate
+
+
+def compile_ir(environment, template):
+    """
+    Builds the IR for the named template. Returns the IR along with the
+    loader's `uptodate` callable.
+    """
+    if environment.loader is None:
+        raise TypeError("The environment does not have a configured loader.")
+
+    source, filename, uptodate = environment.loader.get_source(environment,
+                                                               template)
+    ir = build_ir(environment, source, template, filename)
+    return ir, set_uptodate(ir, uptodate)
+
+
+def compile_module_ir(environment, template):
+    """
+    Builds the IR for the named template as it is included, which renders
+    everything that it outputs. Returns the IR along with the loader's
+    `uptodate` callable.
+    """
+    source, filename, uptodate = environment.loader.get_source(environment,
+                                                               template)
+    ast = parse(environment, source, template, filename)
+    if any(isinstance(node, nodes.Extends) for node in ast.body):
+        raise TypeError("The template %r extends another, so it can't be "
+                        "included." % template)
+    ir = TemplateIR(ast, template, filename)
+    IRBuilder(ir, environment).build_module()
+    return ir, set_uptodate(ir, uptodate)
+
+
+# Template IRs, keyed by environment and then by template name.
+irs = CompilationCache(compile_ir)
+get_ir = irs.get
+
+# The IRs of templates as they are included.
+module_irs = CompilationCache(compile_module_ir)
+get_module_ir = module_irs.get
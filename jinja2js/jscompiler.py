@@ -0,0 +1,640 @@
+from collections import OrderedDict
+from functools import partial
+import os
+import re
+
+from jinja2.compiler import operators
+from jinja2.nodes import Block as BlockNode, Const, Output as OutputNode
+from jinja2.visitor import NodeVisitor
+
+from cache import CompilationCache
+from constprepare import prepare_const
+from ir import (DEFINITIONS, LOOP_HELPERS, accessor_key, get_ir,
+                get_module_ir, is_gettext, is_loop_cycle, is_super,
+                loop_helper)
+
+
+# The JS runtime that compiled templates share, which has to be loaded before
+# they are called.
+RUNTIME_PATH = os.path.join(os.path.dirname(__file__), "runtime.js")
+
+# Block functions that output at least this many values build their output in
+# an array that is joined once, instead of concatenating every value in turn.
+JOIN_THRESHOLD = 32
+
+# Output parts that are always strings: literals, and the calls of the
+# functions that loops are compiled to. Block, macro, and module functions
+# return a bare value when they output nothing else.
+STRING_PART = re.compile(r"'|l\d+\(")
+
+
+def added(parts):
+    """
+    Joins output parts with `+`. Parts that start with two values that may be
+    numbers are started with a string, so that the numbers are joined rather
+    than summed.
+    """
+    if len(parts) > 1 and not any(STRING_PART.match(part) for part in
+                                  parts[:2]):
+        parts = ["''"] + parts
+    return " + ".join(parts)
+
+
+class JSVisitor(NodeVisitor):
+
+    def __init__(self, join_threshold=JOIN_THRESHOLD, compact=False,
+                 delta=False):
+        self.extends = None
+        self.join_threshold = join_threshold
+        # Whether values are read from a compact payload by their slot instead
+        # of by their key. This needs the template's IR.
+        self.compact = compact
+        # Whether payloads that only hold changed values are merged into the
+        # last payload that the template was rendered with.
+        self.delta = delta
+
+        # The IR of the template that is being compiled, if it was compiled
+        # with `compile`.
+        self.ir = None
+        # The `param` lookups made by the block function that is being
+        # compiled, mapped to their position and the number of times they are
+        # made.
+        self.lookups = None
+        # The functions that the loops of the block function that is being
+        # compiled are compiled to, and the loops that are being compiled.
+        self.functions = None
+        self.loops = []
+        # Whether the template applies any filters on the client.
+        self.filters = False
+        # The name of the block function that is being compiled.
+        self.block = None
+        # Whether the template is compiled as it is included, or a macro is
+        # compiled, to a function that is passed the value of each of its
+        # keys as an argument.
+        self.module = False
+
+    def visit(self, *args, **kwargs):
+        output = super(JSVisitor, self).visit(*args, **kwargs)
+        if output is None:
+            return "null"
+        return output
+
+    def safe_visit(self, node):
+        """Returns the expression that reads a value from `param`."""
+        if self.loops:
+            accessor = self.ir.accessors[id(node)]
+            if accessor.loop is not None:
+                return self.field(accessor)
+        return self.read(self.ir.key(node) if self.ir else accessor_key(node))
+
+    def read(self, key):
+        """Returns the expression that reads the value of a key."""
+        if self.module:
+            return "v%d" % self.ir.slots[key]
+        if self.compact:
+            return self.lookup("param[%d]" % self.ir.slots[key])
+        return self.lookup("param['%s']" % prepare_const(key))
+
+    def lookup(self, expression):
+        """
+        Records a `param` lookup made by the current block function. A
+        placeholder is returned in its place, which `hoist` replaces once it
+        knows how often the lookup is made.
+        """
+        if self.lookups is None:
+            return expression
+        if expression not in self.lookups:
+            self.lookups[expression] = [len(self.lookups), 0]
+        entry = self.lookups[expression]
+        # Lookups inside of loops are made once for every item.
+        entry[1] += 2 if self.loops else 1
+        return "\x00%d\x00" % entry[0]
+
+    def field(self, accessor):
+        """Returns the expression that reads a field of a loop's entry."""
+        return "r%d[%d]" % (accessor.loop.depth, accessor.field)
+
+    def expanded(self, node, macro, copies):
+        """
+        Returns the node that a node of a macro's IR was expanded to by a call
+        of the macro, whose copies of the macro's nodes are `copies`.
+        """
+        if id(node) in copies:
+            return copies[id(node)]
+        origin = macro.origins.get(id(node))
+        if origin is None:
+            # The node is the default value of a parameter.
+            return node
+        # The node was expanded from a call of another macro in the macro.
+        call, original = origin
+        inner, inner_copies = self.ir.calls[id(self.expanded(call, macro,
+                                                             copies))]
+        return inner_copies.get(id(original), original)
+
+    def passed(self, node):
+        """
+        Returns the expression for the value of a node that is passed to a
+        macro's function.
+        """
+        accessor = self.ir.accessors.get(id(node))
+        if accessor is None:
+            return self.visit(node)
+        if accessor.loop is not None:
+            return self.field(accessor)
+        return self.read(accessor.key)
+
+    def argument(self, key):
+        """
+        Returns the expression that reads the value of a key of a template
+        that is included, where the template includes it.
+        """
+        # The included template reads `loop` outside of its own loops.
+        attr = key[len("loop."):] if key.startswith("loop.") else None
+        if self.loops and attr in LOOP_HELPERS:
+            return self.loop_helper(attr)
+        names = self.ir.depends.get(key)
+        if names is None:
+            return "null"
+        # The key is a field of the loop that the IR registered it with.
+        if key in self.ir.loop_keys and self.loops:
+            loop = self.loops[-1]
+        else:
+            loop = next((loop for loop in reversed(self.loops) if
+                         not loop.names.isdisjoint(names)), None)
+        if loop is None:
+            return self.read(key)
+        return "r%d[%d]" % (loop.depth, loop.fields.index(key))
+
+    def hoist(self, lookups, generator, functions=()):
+        """
+        Returns the body of a block function. Lookups that are made more than
+        once are made a single time and stored in a local at the top of the
+        function. `functions` are the functions that its loops are compiled
+        to, which are declared after them.
+        """
+        replacements = {}
+        declarations = []
+        for expression, (index, count) in lookups.items():
+            if count == 1:
+                replacements[str(index)] = expression
+                continue
+            local = "p%d" % len(declarations)
+            declarations.append("%s = %s" % (local, expression))
+            replacements[str(index)] = local
+
+        replace = lambda match: replacements[match.group(1)]
+        body = "".join(re.sub(r"\x00(\d+)\x00", replace, function) + " " for
+                       function in functions)
+        body += "return %s;" % re.sub(r"\x00(\d+)\x00", replace, generator)
+        if declarations:
+            return "var %s; %s" % (", ".join(declarations), body)
+        return body
+
+    def block_parts(self, nodes):
+        """
+        Returns the values that are output by a list of nodes, including the
+        values output by any output nodes among them.
+        """
+        parts = []
+        for node in nodes:
+            if isinstance(node, OutputNode):
+                parts.extend(self.block_parts(node.nodes))
+                continue
+            value = self.visit(node)
+            if value and value != "null":
+                parts.append(value)
+        return parts
+
+    def block_visit(self, nodes):
+        return added(self.block_parts(nodes))
+
+    def concatenate(self, parts):
+        """Returns an expression that joins the parts of a block function."""
+        if not parts:
+            return "''"
+        if len(parts) >= self.join_threshold:
+            return "[%s].join('')" % ", ".join(parts)
+        return added(parts)
+
+    def text(self, parts):
+        """
+        Returns an expression that joins parts into a string, even if there
+        is only one part and it may be a number.
+        """
+        if len(parts) == 1 and not STRING_PART.match(parts[0]):
+            parts = ["''"] + parts
+        return self.concatenate(parts)
+
+    def compile(self, ir):
+        """Compiles a template's IR to JS."""
+        self.ir = ir
+        return self.run(ir.ast.body)
+
+    def function(self, ir, name):
+        """
+        Compiles the IR of an included template or a macro to a function that
+        is passed the value of each of its keys in order, as `v1, v2, ...`,
+        and returns everything that it outputs.
+        """
+        self.ir = ir
+        self.module = True
+        self.functions = []
+        body = self.hoist({}, self.concatenate(self.block_parts(ir.ast.body)),
+                          self.functions)
+        self.functions = None
+        if self.filters:
+            body = "var filters = jinja2js.filters; %s" % body
+        return "function %s(%s) {%s}" % (name, ", ".join(
+                "v%d" % slot for slot in range(1, len(ir.keys) + 1)), body)
+
+    def macros(self, ir):
+        """
+        Returns the functions that the macros that a template defines are
+        compiled to, which are declared once in the template's function and
+        called directly by each call of the macro.
+        """
+        return " ".join(
+                JSVisitor(self.join_threshold).function(macro, "m_" + name)
+                for name, macro in ir.macros.items())
+
+    def compile_module(self, ir):
+        """
+        Compiles the IR of a template as it is included (see `get_module_ir`)
+        to a `module(v1, v2, ...)` function. Bundles register each once, under
+        `modules[name]`. The functions of the template's macros are the
+        function's attributes, which templates that import them call.
+        """
+        output = self.function(ir, "module")
+        if not ir.macros:
+            return output
+        return "(function() {%s %s %s return module;})()" % (
+                self.macros(ir), output, " ".join(
+                        "module.%s = m_%s;" % (name, name) for name in
+                        ir.macros))
+
+    def run(self, body):
+        parent = self.ir.parent if self.ir else None
+        blocks = OrderedDict()
+        output = []
+        default_lookups = OrderedDict()
+        default_functions = []
+        for node in body:
+            if isinstance(node, OutputNode):
+                continue
+            if isinstance(node, BlockNode):
+                self.lookups = OrderedDict()
+                self.functions = []
+                self.block = node.name
+                blocks[node.name] = "function() {%s}" % self.hoist(
+                        self.lookups,
+                        self.concatenate(self.block_parts(node.body)),
+                        self.functions)
+                self.block = None
+                continue
+            # Nothing outside of a child's blocks is output.
+            if parent is not None or isinstance(node, DEFINITIONS):
+                continue
+            self.lookups = default_lookups
+            self.functions = default_functions
+            output.append(self.visit(node))
+        self.lookups = self.functions = None
+
+        if output:
+            blocks["__default__"] = "function() {%s}" % self.hoist(
+                    default_lookups, self.concatenate(output),
+                    default_functions)
+
+        if parent is not None:
+            # The blocks that are inherited are the functions of the compiled
+            # parent, which is shared by every template that extends it.
+            blocks = OrderedDict(
+                    (name, blocks.get(name, "parent." + name)) for name in
+                    self.ir.blocks if name in blocks or
+                    name != "__default__" or parent.outputs_default)
+
+        output = "return {%s};" % ", ".join(
+                "%s: %s" % (block, function) for block, function in
+                blocks.items())
+        if parent is not None:
+            output = "var parent = templates['%s'](param%s); %s" % (
+                    prepare_const(self.ir.extends),
+                    ", true" if self.compact or self.delta else "", output)
+        if self.ir is not None and self.ir.macros:
+            output = "%s %s" % (self.macros(self.ir), output)
+        if self.filters:
+            output = "var filters = jinja2js.filters; %s" % output
+
+        checks = []
+        if self.delta:
+            checks.append(
+                    "if (param.__delta__) {var last = template.last; "
+                    "if (!last) {throw new Error('There is no payload to "
+                    "apply the changes to.');} for (var key in param) "
+                    "{if (key !== '__delta__') {last[key] = param[key];}} "
+                    "param = last;} template.last = param;")
+        if self.compact:
+            # Refuse payloads that were built from a different slot table.
+            checks.append("if (param[0] !== '%s') {throw new Error('The "
+                          "payload does not match the template.');}" %
+                          self.ir.slot_hash)
+        if checks:
+            # Templates that are called by a template that extends them are
+            # passed the child's payload, which the child has checked.
+            return ("function template(param, inherited) {if (!inherited) "
+                    "{%s} %s}" % (" ".join(checks), output))
+        return "function template(param) {%s}" % output
+
+    def visit_Include(self, node):
+        module = self.ir.includes.get(id(node)) if self.ir else None
+        if module is None:
+            return None
+        # The included template is compiled once, and passed the values that
+        # it reads as the including template reads them.
+        return "modules['%s'](%s)" % (prepare_const(module.name), ", ".join(
+                self.argument(key) for key in module.keys))
+
+    def visit_Macro(self, node):
+        # Macros are compiled to functions of their own (see `macros`).
+        return None
+
+    def visit_Import(self, node):
+        # The macros that are imported are resolved by the IR.
+        return None
+
+    visit_FromImport = visit_Import
+
+    def visit_Extends(self, node):
+        # The template that is extended is resolved by the IR.
+        if isinstance(node.template, Const):
+            self.extends = node.template.value
+
+    def visit_If(self, node):
+        # Conditionals are lowered to `?:` so that rendering them doesn't
+        # allocate and call a closure.
+        test = (self.visit(node.test) if isinstance(node.test, Const) else
+                self.visit_value(node.test))
+        return "(%s ? %s : %s)" % (test, self.branch_visit(node.body),
+                                   self.branch_visit(node.else_))
+
+    def visit_CondExpr(self, node):
+        return "(%s ? %s : %s)" % (self.visit(node.test),
+                                   self.visit(node.expr1),
+                                   self.visit(node.expr2) if node.expr2 else
+                                       "''")
+
+    def branch_visit(self, nodes):
+        # `+` binds more tightly than `?:`, so branches don't need parentheses.
+        return self.block_visit(nodes) or "''"
+
+    def visit_For(self, node):
+        """
+        Loops are compiled to a function that is declared once in the block
+        function and called with the loop's entries, along with the entries of
+        the loops that it is in. The function renders each item in an indexed
+        `for` over the entries, so no closure is made for each item.
+        """
+        if self.ir is None:
+            raise TypeError("Loops can only be compiled from a template's IR.")
+        loop = self.ir.loops[id(node)]
+        depth = loop.depth
+        if loop.accessor.loop is not None:
+            entries = self.field(loop.accessor)
+        else:
+            entries = self.read(loop.accessor.key)
+
+        # The function is named for its position in the block function.
+        index = len(self.functions)
+        self.functions.append(None)
+        outer = ["r%d" % level for level in range(depth)]
+
+        self.loops.append(loop)
+        body = self.concatenate(self.block_parts(node.body))
+        self.loops.pop()
+        if node.else_:
+            result = "n%d ? o : %s" % (depth,
+                                       self.text(self.block_parts(node.else_)))
+        else:
+            result = "o"
+
+        name = "l%d" % index
+        self.functions[index] = (
+                "function %(name)s(%(args)s) {var o = '', "
+                "n%(d)d = a%(d)d ? a%(d)d.length : 0, i%(d)d, r%(d)d; "
+                "for (i%(d)d = 0; i%(d)d < n%(d)d; i%(d)d++) "
+                "{r%(d)d = a%(d)d[i%(d)d]; o += %(body)s;} "
+                "return %(result)s;}" % {
+                    "name": name, "args": ", ".join(["a%d" % depth] + outer),
+                    "d": depth, "body": body, "result": result})
+        return "%s(%s)" % (name, ", ".join([entries] + outer))
+
+    def loop_helper(self, attr):
+        """
+        Returns the expression for an attribute of `loop`, which is computed
+        from the index of the current item only where it is read.
+        """
+        depth = self.loops[-1].depth
+        return {
+            "index": "(i%d + 1)",
+            "index0": "i%d",
+            "revindex": "(n%d - i%d)",
+            "revindex0": "(n%d - i%d - 1)",
+            "first": "(i%d === 0)",
+            "last": "(i%d === n%d - 1)",
+            "length": "n%d",
+        }[attr].replace("%d", str(depth))
+
+    def visit_Call(self, node):
+        if is_gettext(node):
+            return "gettext('%s')" % prepare_const(node.args[0].value)
+        call = self.ir.calls.get(id(node)) if self.ir else None
+        if call is not None:
+            macro, copies = call
+            if macro.name == self.ir.name:
+                function = "m_%s" % macro.ast.name
+            else:
+                function = "modules['%s'].%s" % (prepare_const(macro.name),
+                                                 macro.ast.name)
+            return "%s(%s)" % (function, ", ".join(
+                    self.passed(self.expanded(macro.key_nodes[key], macro,
+                                              copies)) for key in macro.keys))
+        parent = self.ir.parent if self.ir else None
+        if (is_super(node) and parent is not None and
+            self.block in parent.blocks):
+            return "parent.%s()" % self.block
+        if self.loops and is_loop_cycle(node):
+            return "[%s][i%d %% %d]" % (", ".join(map(self.visit, node.args)),
+                                        self.loops[-1].depth, len(node.args))
+        return self.safe_visit(node)
+
+    def visit_value(self, node):
+        if self.loops and loop_helper(node):
+            return self.loop_helper(loop_helper(node))
+        return self.safe_visit(node)
+
+    visit_Name = visit_Getattr = visit_Getitem = visit_Test = \
+    visit_Keyword = visit_value
+
+    def visit_Filter(self, node):
+        filter = self.ir.filters.get(id(node)) if self.ir else None
+        if filter is None:
+            return self.safe_visit(node)
+        # The filter is applied by the shared runtime (see `RUNTIME_PATH`).
+        self.filters = True
+        function, args = filter
+        return "filters.%s(%s)" % (function, ", ".join(
+                [self.visit(node.node)] +
+                ["null" if arg is None else self.visit(arg) for arg in args]))
+
+    def visit_Const(self, node):
+        if node.value is None:
+            return "null"
+
+        if isinstance(node.value, bool):
+            return str(node.value).lower()
+        if isinstance(node.value, (int, float, long)):
+            return str(node.value)
+
+        return "'%s'" % prepare_const(node.value)
+
+    def visit_TemplateData(self, node):
+        data = node.data
+
+        if not data.strip():
+            return ""
+
+        while "  " in data:
+            data = data.replace("  ", " ")
+        while "\n " in data:
+            data = data.replace("\n ", "\n")
+        while "\n\n" in data:
+            data = data.replace("\n\n", "\n")
+
+        data = data.replace("\\", "\\\\")
+        data = data.replace("\n", "\\n")
+        data = data.replace("\t", "\\t")
+        data = data.replace("\r", "\\r")
+        data = data.replace("'", "\\'")
+        data = data.replace(">\\n </", "></")
+
+        return "'%s'" % data
+
+    def visit_And(self, node):
+        return "(%s && %s)" % (self.visit(node.left), self.visit(node.right))
+
+    def visit_Or(self, node):
+        return "(%s || %s)" % (self.visit(node.left), self.visit(node.right))
+
+    def visit_Not(self, node):
+        return "!(" + self.visit(node.node) + ")"
+
+    def visit_Compare(self, node):
+        comparisons = []
+        left = self.visit(node.expr)
+        for op in node.ops:
+            right = self.visit(op.expr)
+            # JS has no `in` operator for strings and arrays.
+            if op.op in ("in", "notin"):
+                comparisons.append("(%s.indexOf(%s) %s -1)" % (
+                        right, left, "!=" if op.op == "in" else "=="))
+            else:
+                comparisons.append("(%s %s %s)" % (left, operators[op.op],
+                                                   right))
+            left = right
+        return "(%s)" % " && ".join(comparisons)
+
+    def visit_Assign(self, node):
+        return None
+
+    def visit_Output(self, node):
+        return self.block_visit(node.nodes)
+
+    def visit_Block(self, node):
+        return self.block_visit(node.body)
+
+    def visit_ExprStmt(self, node):
+        return self.visit(node.node)
+
+    def visit_FloorDiv(self, node):
+        return "Math.floor(%s / %s)" % (self.visit(node.left),
+                                        self.visit(node.right))
+
+    def visit_Pow(self, node):
+        return "Math.pow(%s, %s)" % (self.visit(node.left),
+                                     self.visit(node.right))
+
+    def binop(operator):
+        def visitor(self, node):
+            return "(%s %s %s)" % (self.visit(node.left),
+                                   operator,
+                                   self.visit(node.right))
+        return visitor
+
+    def uop(operator):
+        def visitor(self, node):
+            return "(%s %s)" % (operator, self.visit(node.node))
+        return visitor
+
+    visit_Add = binop("+")
+    visit_Sub = binop("-")
+    visit_Mul = binop("*")
+    visit_Div = binop("/")
+    visit_Mod = binop("%")
+
+    visit_Pos = uop("+")
+    visit_Neg = uop("-")
+    del binop, uop
+
+    def visit_Concat(self, node):
+        return " + ".join(self.visit(node) for node in node.nodes)
+
+    def visit_Tuple(self, node):
+        if not node.items:
+            return "(, )"
+        return "(%s)" % ", ".join(map(self.visit, node.items))
+
+    def visit_List(self, node):
+        return "[%s]" % ", ".join(map(self.visit, node.items))
+
+    def visit_Dict(self, node):
+        return "{%s}" % ", ".join("%s: %s" % (self.visit(node.key),
+                                              self.visit(node.value)) for
+                                  node in node.items)
+
+
+def get_runtime():
+    """Returns the source of the JS runtime."""
+    with open(RUNTIME_PATH) as fd:
+        return fd.read()
+
+
+def compile_js(environment, template, compact=False):
+    """
+    Compiles the named template to JS from its IR. Returns the JS along with
+    the loader's `uptodate` callable.
+    """
+    ir = get_ir(environment, template)
+    return JSVisitor(compact=compact).compile(ir), ir.uptodate
+
+
+# Compiled JS, keyed by environment and then by template name.
+scripts = CompilationCache(compile_js)
+get_js = scripts.get
+
+# Compiled JS that reads compact payloads.
+compact_scripts = CompilationCache(partial(compile_js, compact=True))
+get_compact_js = compact_scripts.get
+
+
+def compile_module_js(environment, template):
+    """
+    Compiles the named template as it is included. Returns the JS along with
+    the loader's `uptodate` callable.
+    """
+    ir = get_module_ir(environment, template)
+    return JSVisitor().compile_module(ir), ir.uptodate
+
+
+# The compiled JS of included templates, which is the same for templates that
+# read keyed and compact payloads.
+module_scripts = CompilationCache(compile_module_js)
+get_module_js = module_scripts.get
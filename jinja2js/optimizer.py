@@ -0,0 +1,97 @@
+"""
+An optimization pass that is run over templates before they are compiled to JS.
+On top of the constant folding and dead code elimination that Jinja's own
+optimizer does, adjacent pieces of literal output are merged so that they are
+emitted as a single string instead of being concatenated at runtime.
+"""
+
+from jinja2 import nodes
+from jinja2.optimizer import Optimizer
+from jinja2.utils import escape
+
+
+# The types of constants that JSVisitor can emit.
+EMITTABLE = (str, unicode, int, long, float, bool, type(None))
+
+
+def optimize(node, environment):
+    """Optimizes a template's AST in place and returns it."""
+    return JSOptimizer(environment).visit(node)
+
+
+class JSOptimizer(Optimizer):
+
+    def fold(self, node):
+        node = self.generic_visit(node)
+        try:
+            value = node.as_const()
+        except nodes.Impossible:
+            return node
+        if not isinstance(value, EMITTABLE):
+            return node
+        return nodes.Const(value, lineno=node.lineno,
+                           environment=self.environment)
+
+    visit_Add = visit_Sub = visit_Mul = visit_Div = visit_FloorDiv = \
+    visit_Pow = visit_Mod = visit_And = visit_Or = visit_Pos = visit_Neg = \
+    visit_Not = visit_Compare = visit_Getitem = visit_Getattr = visit_Call = \
+    visit_Filter = visit_Test = fold
+
+    def visit_CondExpr(self, node):
+        node = self.generic_visit(node)
+        try:
+            test = node.test.as_const()
+        except nodes.Impossible:
+            return self.fold(node)
+        if test:
+            return node.expr1
+        if node.expr2 is None:
+            return nodes.Const(u"", lineno=node.lineno,
+                               environment=self.environment)
+        return node.expr2
+
+    def visit_Output(self, node):
+        node = self.generic_visit(node)
+        eval_ctx = nodes.EvalContext(self.environment)
+
+        merged = []
+        literal = []
+        for child in node.nodes:
+            data = self.literal_data(child, eval_ctx)
+            if data is None:
+                self.flush(literal, merged)
+                merged.append(child)
+                continue
+            literal.append((child, data))
+        self.flush(literal, merged)
+
+        node.nodes = merged
+        return node
+
+    def literal_data(self, node, eval_ctx):
+        """
+        Returns the text that a node outputs if it is known at compile time,
+        otherwise `None`.
+        """
+        if isinstance(node, nodes.TemplateData):
+            return node.data
+        # Booleans and floats are not formatted the same way in JS.
+        if (not isinstance(node, nodes.Const) or
+            isinstance(node.value, (bool, float)) or
+            not isinstance(node.value, (str, unicode, int, long))):
+            return None
+
+        data = unicode(node.value)
+        if eval_ctx.autoescape:
+            data = unicode(escape(data))
+        return data
+
+    def flush(self, literal, merged):
+        data = u"".join(data for child, data in literal)
+        if len(literal) == 1 and data:
+            merged.append(literal[0][0])
+        elif data:
+            merged.append(nodes.TemplateData(
+                data, lineno=literal[0][0].lineno,
+                environment=self.environment))
+        del literal[:]
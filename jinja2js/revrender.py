@@ -1,9 +1,9 @@
-import json
+from threading import Lock
+from weakref import WeakSet
 
-import jinja2.environment
-from jinja2.runtime import new_context
-
-from jsonextractor import JSONVisitor
+from cache import environment_state
+from extractor import ENGINES, Extractor
+from ir import irs, module_irs
 
 # This is the environment that is used. If Jingo is used to load templates, this
 # will get set by set_env().
@@ -20,60 +20,91 @@ def set_env(environment):
     env = environment
 
 
-def extract_template(request, template, context=None):
-    """
-    Extracts the values used in the template along with the rendered versions of
-    those values. To be used with the output of the `compile_to_js.py` template
-    compiler.
-    """
-    def get_context():
-        c = {} if context is None else context.copy()
+# If set, the bytecode of compiled extractors is stored here so that new
+# processes do not have to generate it again. See `jinja2js.bccache`.
+bytecode_cache = None
 
-        try:
-            from django.template.context import get_standard_processors
-            for processor in get_standard_processors():
-                c.update(processor(request))
-        except ImportError:
-            pass
+def set_bytecode_cache(cache):
+    global bytecode_cache
+    bytecode_cache = cache
 
-        return c
 
-    if isinstance(template, jinja2.environment.Template):
-        raise Exception("Pre-compiled templates may not be used with the "
-                        "Jinja2JS extractor.")
+# The engine that extractors are built with. See `jinja2js.extractor.ENGINES`.
+engine = "codegen"
 
-    if env.loader is None:
-        raise TypeError("The environment does not have a configured loader.")
+def set_engine(name):
+    global engine
+    if name not in ENGINES:
+        raise ValueError("There is no extractor engine named %r." % name)
+    engine = name
 
-    source, filename, uptodate = env.loader.get_source(env, template)
 
-    ast = env._parse(source, name=None, filename=filename)
-    compiler = JSONVisitor(env, name=None, filename=filename)
-    compiler.visit(ast)
-    gen_python = compiler.stream.getvalue()
+# The environments that the functions below made an extractor for. Each
+# extractor is kept on its environment (see `environment_state`), since it
+# refers to the environment and would otherwise keep it alive.
+extractors = WeakSet()
+extractors_lock = Lock()
 
-    compiled = compile(gen_python, filename, "exec")
-    namespace = {}
-    exec compiled in namespace
 
-    jinj_context = new_context(env, None, blocks={}, vars=get_context(),
-                               globals=env.globals)
-    namespace["root"](jinj_context, env)
-    vars = jinj_context.vars
-    output = {}
-    for key, var in vars.items():
-        if not isinstance(var, (int, float, long, str, unicode, bool)):
-            var = bool(var)
-        output[key] = var
-    return output
+def get_extractor_for(environment):
+    """
+    Returns the `Extractor` for an environment that uses the current engine
+    and bytecode cache, creating it if needed.
+    """
+    state = environment_state(environment)
+    extractor = state.get("extractor")
+    if (extractor is None or extractor.engine != engine or
+        extractor.bytecode_cache is not bytecode_cache):
+        with extractors_lock:
+            extractor = state.get("extractor")
+            if (extractor is None or extractor.engine != engine or
+                extractor.bytecode_cache is not bytecode_cache):
+                extractor = state["extractor"] = Extractor(
+                        environment, engine, bytecode_cache)
+                extractors.add(environment)
+    return extractor
+
+
+def get_extractor(environment, template):
+    """Returns the compiled extractor for the named template."""
+    return get_extractor_for(environment).get(template)
+
+
+def clear_caches():
+    """
+    Drops every compiled extractor and template IR for every environment,
+    along with every serialized payload.
+    """
+    with extractors_lock:
+        for environment in list(extractors):
+            environment_state(environment).pop("extractor", None)
+        extractors.clear()
+    irs.clear()
+    module_irs.clear()
 
 
-try:
-    from django import http
-except ImportError:
-    http = None
+def extract_template(request, template, context=None, compact=False,
+                     blocks=None):
+    """
+    Extracts the values used in the template along with the rendered versions of
+    those values. To be used with the output of the `compile_to_js.py` template
+    compiler. See `Extractor.extract_template`.
+    """
+    return get_extractor_for(env).extract_template(request, template, context,
+                                                   compact, blocks)
+
+
+def extract_delta(request, template, context=None, token=None,
+                  compact=False, blocks=None):
+    """
+    Extracts the values used in the template that changed since the payload
+    that `token` was returned with. See `Extractor.extract_delta`.
+    """
+    return get_extractor_for(env).extract_delta(request, template, context,
+                                                token, compact, blocks)
+
 
-def extract(request, template, context=None, **kwargs):
-    extracted = extract_template(request, template, context)
-    kwargs.setdefault("content_type", "application/json")
-    return http.HttpResponse(json.dumps(extracted), **kwargs)
+def extract(request, template, context=None, compact=False, delta=False,
+            blocks=None, **kwargs):
+    return get_extractor_for(env).extract(request, template, context, compact,
+                                          delta, blocks, **kwargs)
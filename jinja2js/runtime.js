@@ -0,0 +1,76 @@
+// The runtime that templates compiled by Jinja2JS share. It is loaded once per
+// page, before any compiled template is called, and implements the filters
+// that are applied on the client instead of the server.
+var jinja2js = jinja2js || {};
+jinja2js.filters = jinja2js.filters || (function() {
+    // Values that were undefined on the server are sent as `null`.
+    function string(value) {
+        return value == null ? "" : String(value);
+    }
+
+    return {
+        length: function(value) {
+            if (value == null) {
+                return 0;
+            }
+            if (typeof value.length === "number") {
+                return value.length;
+            }
+            var count = 0;
+            for (var key in value) {
+                if (Object.prototype.hasOwnProperty.call(value, key)) {
+                    count++;
+                }
+            }
+            return count;
+        },
+        // `default` is a reserved word in older browsers.
+        default_: function(value, default_value, boolean) {
+            if (default_value == null) {
+                default_value = "";
+            }
+            if (boolean ? !value : value == null) {
+                return default_value;
+            }
+            return value;
+        },
+        join: function(value, d) {
+            var parts = [];
+            for (var i = 0, n = value ? value.length : 0; i < n; i++) {
+                parts.push(string(value[i]));
+            }
+            return parts.join(d == null ? "" : d);
+        },
+        upper: function(value) {
+            return string(value).toUpperCase();
+        },
+        lower: function(value) {
+            return string(value).toLowerCase();
+        },
+        truncate: function(value, length, killwords, end) {
+            value = string(value);
+            if (length == null) {
+                length = 255;
+            }
+            if (end == null) {
+                end = "...";
+            }
+            if (value.length <= length) {
+                return value;
+            }
+            if (killwords) {
+                return value.substring(0, length) + end;
+            }
+            var words = value.split(" "), result = [], size = 0;
+            for (var i = 0; i < words.length; i++) {
+                size += words[i].length + 1;
+                if (size > length) {
+                    break;
+                }
+                result.push(words[i]);
+            }
+            result.push(end);
+            return result.join(" ");
+        }
+    };
+})();
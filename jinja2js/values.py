@@ -0,0 +1,51 @@
+"""
+The values that extractors pass to the client.
+"""
+
+from collections import OrderedDict
+
+from jinja2.runtime import Undefined
+
+# The types of values that are passed to the client as they are. Anything
+# else is passed as whether it is true. Extracted values are canonical, so
+# that equal payloads have the same `repr` (see `payload_digest`): strings are
+# passed as unicode, and dicts with their keys in order.
+PRIMITIVES = (int, float, long, str, unicode, bool)
+
+
+class Entries(list):
+    """
+    The entries that are extracted for the items of a loop, each of which is a
+    list of the values that the loop's body reads for the item.
+    """
+
+
+def client_value(value):
+    """
+    Returns the value that is passed to the client for an extracted value.
+    """
+    if isinstance(value, str):
+        return value.decode("utf-8")
+    if isinstance(value, PRIMITIVES) or isinstance(value, Entries):
+        return value
+    return bool(value)
+
+
+def raw_value(value):
+    """
+    Returns the value that is passed to the client for an extracted value that
+    the client filters. Sequences and mappings are passed as lists and
+    objects, and undefined values as `None`. Any other object is passed as the
+    text that the server would render it as, which is what the filters apply
+    to.
+    """
+    if isinstance(value, Undefined):
+        return None
+    if value is None or isinstance(value, PRIMITIVES):
+        return client_value(value)
+    if isinstance(value, dict):
+        return OrderedDict(sorted((unicode(key), raw_value(item)) for
+                                  key, item in value.items()))
+    if hasattr(value, "__len__") and hasattr(value, "__iter__"):
+        return map(raw_value, value)
+    return unicode(value)
@@ -0,0 +1,46 @@
+from collections import namedtuple
+import time
+
+from ir import irs, module_irs
+from jscompiler import get_js, module_scripts, scripts
+from revrender import get_extractor_for
+
+
+WarmupResult = namedtuple("WarmupResult", "name seconds error")
+
+
+def warmup(environment, filter_func=None, extensions=None, extractor=None):
+    """
+    Compiles the extractor and the JS for every template that the
+    environment's loader can list, filling the caches. This is meant to be
+    called in the master process of a pre-forking server so that the workers
+    inherit the compiled templates.
+
+    `filter_func` and `extensions` select templates the same way they do for
+    `Environment.list_templates`. Returns a `WarmupResult` for each template
+    with the time it took to compile and the exception that was raised while
+    compiling it, if any.
+
+    The extractors are compiled with `extractor`, which is the one that the
+    module-level functions use by default. That one is replaced by
+    `set_engine` and `set_bytecode_cache`, so call those first. The caches
+    are grown to hold every template that is listed.
+    """
+    if extractor is None:
+        extractor = get_extractor_for(environment)
+    names = environment.list_templates(extensions, filter_func)
+    for cache in (extractor.cache, irs, module_irs, scripts, module_scripts):
+        cache.reserve(environment, len(names))
+
+    results = []
+    for name in names:
+        start = time.time()
+        error = None
+        try:
+            extractor.get(name)
+            get_js(environment, name)
+        except Exception, exc:
+            error = exc
+        results.append(WarmupResult(name, time.time() - start, error))
+
+    return results
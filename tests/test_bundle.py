@@ -0,0 +1,129 @@
+import os
+import shutil
+from StringIO import StringIO
+import tempfile
+
+from jinja2js.bundle import (compile_templates, find_templates, read_bundle,
+                             update_bundle, write_bundle)
+
+
+TEMPLATES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         "templates")
+
+
+class TestBundle(object):
+    """
+    Test that whole template trees are compiled into a single bundle.
+    """
+
+    def test_find_templates(self):
+        names = [name for name, path in find_templates([TEMPLATES])]
+        assert names == ["condexpr.html", "getattr.html", "getitem.html",
+                         "name.html"]
+
+    def test_bundle(self):
+        templates = find_templates([os.path.join(TEMPLATES, "get*.html")])
+        results = compile_templates(templates, processes=1)
+        assert all(result[-1] is None for result in results)
+
+        output = StringIO()
+        write_bundle(output, [result[:2] for result in results])
+        assert "jinja2js.filters = " in output.getvalue()
+        lines = [line for line in output.getvalue().splitlines() if
+                 line.startswith("templates[")]
+        assert len(lines) == 2
+        assert lines[0].startswith('templates["%s"] = function template(' %
+                                   templates[0][0])
+
+
+class TestIncrementalBundle(object):
+    """
+    Test that bundles are only partially recompiled when templates change.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.templates = os.path.join(self.directory, "templates")
+        self.output = os.path.join(self.directory, "templates.js")
+        os.mkdir(self.templates)
+
+        self.write("base.html", "{% block a %}{{ foo }}{% endblock %}")
+        self.write("child.html", "{% extends 'base.html' %}"
+                                 "{% block b %}{{ bar }}{% endblock %}")
+        self.write("other.html", "{% block c %}{{ zap }}{% endblock %}")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, source):
+        path = os.path.join(self.templates, name)
+        with open(path, "w") as fd:
+            fd.write(source)
+        # Make sure that the change is noticed even if the modification time
+        # has a low resolution.
+        if os.path.exists(self.output + ".manifest"):
+            os.utime(path, (0, 0))
+
+    def update(self):
+        results = update_bundle([self.templates], self.output, processes=1)
+        return sorted(result[0] for result in results)
+
+    def test_incremental(self):
+        assert self.update() == ["base.html", "child.html", "other.html"]
+        assert self.update() == []
+
+        self.write("base.html", "{% block a %}{{ foo2 }}{% endblock %}")
+        assert self.update() == ["base.html", "child.html"]
+
+        with open(self.output) as fd:
+            lines = read_bundle(fd)
+        assert list(lines) == ["base.html", "child.html", "other.html"]
+        assert "foo2" in lines["base.html"]
+
+    def test_inheritance(self):
+        self.update()
+        with open(self.output) as fd:
+            lines = read_bundle(fd)
+        # The parent's blocks are shared rather than compiled into the child.
+        assert "templates['base.html'](param)" in lines["child.html"]
+        assert "a: parent.a" in lines["child.html"]
+        assert "param['foo']" not in lines["child.html"]
+
+    def test_includes(self):
+        self.write("row.html", "<tr>{{ zap }}</tr>")
+        self.write("other.html", "{% block c %}{% include 'row.html' %}"
+                                 "{% include 'row.html' %}{% endblock %}")
+        self.update()
+        with open(self.output) as fd:
+            bundle = fd.readlines()
+        # The included template is registered once, and called by its users.
+        assert list(read_bundle(bundle, "modules")) == ["row.html"]
+        assert ("return '' + modules['row.html'](p0) + "
+                "modules['row.html'](p0);" in
+                read_bundle(bundle)["other.html"])
+
+        self.write("other.html", "{% block c %}{{ zap }}{% endblock %}")
+        assert self.update() == ["other.html"]
+        with open(self.output) as fd:
+            assert list(read_bundle(fd, "modules")) == []
+
+    def test_failed(self):
+        os.remove(os.path.join(self.templates, "base.html"))
+        results = update_bundle([self.templates], self.output, processes=1)
+        assert [result[0] for result in results if result[5]] == ["child.html"]
+        assert self.update() == ["child.html"]
+
+        # The child is compiled once its parent exists, though it is unchanged.
+        self.write("base.html", "{% block a %}{{ foo }}{% endblock %}")
+        assert self.update() == ["base.html", "child.html"]
+        with open(self.output) as fd:
+            assert list(read_bundle(fd)) == ["other.html", "base.html",
+                                             "child.html"]
+
+    def test_removed(self):
+        self.update()
+        os.remove(os.path.join(self.templates, "other.html"))
+        assert self.update() == []
+
+        with open(self.output) as fd:
+            assert list(read_bundle(fd)) == ["base.html", "child.html"]
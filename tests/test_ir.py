@@ -0,0 +1,457 @@
+import re
+
+import jinja2
+
+from jinja2js.ir import Conditional, build_ir, get_ir, get_module_ir
+from jinja2js.jscompiler import JSVisitor
+from jinja2js.revrender import extract_template, set_engine, set_env
+
+
+def source_loader(templates):
+    return jinja2.FunctionLoader(
+            lambda name: (templates[name], None, lambda: True))
+
+
+class TestIR(object):
+    """
+    Test that the JS compiler and the JSON extractor agree on the values that
+    are passed between them.
+    """
+
+    template = (u"{% block content %}{% if user.is_staff %}"
+                u"{{ user.name|upper }}{% else %}{{ items['a\\'b'] }}"
+                u"{% endif %}{{ _('Hi') }}{{ user.is_staff }}{% endblock %}")
+
+    def setUp(self):
+        self.env = jinja2.Environment()
+        self.env.add_extension("jinja2.ext.i18n")
+        self.env.loader = source_loader({"test.html": self.template})
+        set_env(self.env)
+
+    def test_keys(self):
+        ir = build_ir(self.env, self.template)
+        assert ir.keys == ["user.is_staff", "user.name", "items['a'b']"]
+        assert ir.blocks["content"].steps[0].key == "user.is_staff"
+        assert isinstance(ir.blocks["content"].steps[1], Conditional)
+        assert ir.block_keys == {"content": ir.keys, "__default__": []}
+
+    def test_keys_agree(self):
+        ir = build_ir(self.env, self.template)
+        output = JSVisitor().compile(ir)
+        read = [eval(u"u'%s'" % key) for key in
+                re.findall(r"param\['((?:[^'\\]|\\.)*)'\]", output)]
+        assert set(read) == set(ir.keys)
+
+        data = extract_template(None, "test.html",
+                                {"user": {"is_staff": True, "name": "x"},
+                                 "items": {"a'b": 1}})
+        assert data == {"user.is_staff": True, "user.name": "x"}
+
+    def test_else_branch(self):
+        data = extract_template(None, "test.html",
+                                {"user": {"is_staff": False},
+                                 "items": {"a'b": 1}})
+        assert data == {"user.is_staff": False, "items['a'b']": 1}
+
+    def test_compact(self):
+        ir = build_ir(self.env, self.template)
+        output = JSVisitor(compact=True).compile(ir)
+        assert "param[0] !== '%s'" % ir.slot_hash in output
+        assert "param[2]" in output
+        assert "param['" not in output
+
+        data = extract_template(None, "test.html",
+                                {"user": {"is_staff": True, "name": "x"},
+                                 "items": {"a'b": 1}}, compact=True)
+        assert data == [ir.slot_hash, True, "x", None]
+
+
+class TestEvaluatedOnce(object):
+    """
+    Test that the extractor evaluates each accessor once per request.
+    """
+
+    def setUp(self):
+        self.calls = 0
+        self.env = jinja2.Environment()
+        self.env.loader = source_loader({
+            "once.html": u"{% block content %}{% if count() %}{{ count() }}"
+                         u"{% endif %}{{ count() }}{% set count = other %}"
+                         u"{{ count() }}{% endblock %}",
+            "branches.html": u"{% block content %}{% if x %}{{ count() }}"
+                             u"{% else %}{{ count() }}{% endif %}"
+                             u"{{ count() }}{% endblock %}",
+            "blocks.html": u"{% block a %}{{ count() }}{% endblock %}"
+                           u"{% block b %}{{ count() }}{% endblock %}"})
+        set_env(self.env)
+
+    def tearDown(self):
+        set_engine("codegen")
+
+    def count(self):
+        self.calls += 1
+        return self.calls
+
+    def test_once(self):
+        data = extract_template(None, "once.html",
+                                {"count": self.count, "other": lambda: 0})
+        assert self.calls == 1
+        assert data["count()"] == 0
+
+    def test_branches(self):
+        for engine in ("codegen", "interpreter"):
+            set_engine(engine)
+            self.calls = 0
+            extract_template(None, "branches.html",
+                             {"count": self.count, "x": engine == "codegen"})
+            assert self.calls == 1
+
+    def test_blocks(self):
+        for engine in ("codegen", "interpreter"):
+            set_engine(engine)
+            self.calls = 0
+            data = extract_template(None, "blocks.html",
+                                    {"count": self.count})
+            assert self.calls == 1
+            assert data == {"count()": 1}
+            # Each block that is asked for evaluates the values it reads.
+            extract_template(None, "blocks.html", {"count": self.count},
+                             blocks=["b"])
+            assert self.calls == 2
+
+
+class TestFilters(object):
+    """
+    Test that the values that the client filters are passed as they are.
+    """
+
+    template = (u"{% block content %}{{ tags|join(', ') }}{{ tags|length }}"
+                u"{{ items|length }}{{ missing|default('-') }}{{ name|upper }}"
+                u"{{ html|e }}{% endblock %}")
+
+    def setUp(self):
+        self.env = jinja2.Environment()
+        self.env.loader = source_loader({"filters.html": self.template})
+        set_env(self.env)
+
+    def test_raw(self):
+        data = extract_template(None, "filters.html",
+                                {"tags": ("a", "b"), "items": [1, 2, 3],
+                                 "name": "x"})
+        # The length of a value that is passed anyway is counted by the
+        # client; other values are only passed as their length.
+        assert data == {"tags": ["a", "b"], "items|length": 3,
+                        "missing": None, "name": "x", "html|e": ""}
+
+    def test_markup(self):
+        # Values that are already safe are escaped on the server, once.
+        data = extract_template(None, "filters.html",
+                                {"html": jinja2.Markup("<b>x</b>")})
+        assert data["html|e"] == "<b>x</b>"
+        output = JSVisitor().compile(build_ir(self.env, self.template))
+        assert "filters.length(p0)" in output
+        assert "param['items|length']" in output
+        assert "param['html|e']" in output
+
+    def test_objects(self):
+        # Objects are passed as the text that the server would filter.
+        class User(object):
+            def __init__(self, name):
+                self.name = name
+
+            def __unicode__(self):
+                return self.name
+
+        data = extract_template(None, "filters.html",
+                                {"tags": [User("alice"), User("bob")],
+                                 "name": User("x")})
+        assert data["tags"] == ["alice", "bob"]
+        assert data["name"] == "x"
+
+    def test_replaced_filter(self):
+        self.env.filters["upper"] = lambda value: value
+        ir = build_ir(self.env, self.template)
+        assert ir.keys == ["tags", "items|length", "missing", "name|upper",
+                           "html|e"]
+
+
+class TestInheritance(object):
+    """
+    Test that templates that extend others are flattened with them.
+    """
+
+    def setUp(self):
+        self.env = jinja2.Environment()
+        self.env.loader = source_loader({
+            "base.html": u"{% block a %}{{ foo }}{% endblock %}"
+                         u"{% block b %}{{ bar }}{% endblock %}",
+            "child.html": u"{% extends 'base.html' %}"
+                          u"{% block b %}{{ zap }}{{ super() }}{% endblock %}"
+                          u"{% block c %}{{ baz }}{% endblock %}"})
+        set_env(self.env)
+
+    def test_blocks(self):
+        ir = get_ir(self.env, "child.html")
+        assert ir.parent is get_ir(self.env, "base.html")
+        # The parent's keys come first, in the parent's slots.
+        assert ir.keys == ["foo", "bar", "zap", "baz"]
+        assert list(ir.blocks) == ["a", "b", "__default__", "c"]
+        assert ir.block_keys["a"] == ["foo"]
+        assert ir.block_keys["b"] == ["zap", "bar"]
+
+    def test_js(self):
+        output = JSVisitor().compile(get_ir(self.env, "child.html"))
+        assert "var parent = templates['base.html'](param);" in output
+        assert ("{a: parent.a, b: function() {return '' + param['zap'] + "
+                "parent.b();}, c: function() {return param['baz'];}}" in
+                output)
+
+    def test_extract(self):
+        data = extract_template(None, "child.html",
+                                {"foo": 1, "bar": 2, "zap": 3, "baz": 4})
+        assert data == {"foo": 1, "bar": 2, "zap": 3, "baz": 4}
+
+
+class TestIncludes(object):
+    """
+    Test that included templates are compiled once and extracted with the
+    templates that include them.
+    """
+
+    def setUp(self):
+        self.env = jinja2.Environment()
+        self.env.loader = source_loader({
+            "row.html": u"<tr>{{ item.name }}{{ title }}</tr>",
+            "page.html": u"{% block content %}{{ title }}"
+                         u"{% for item in items %}{% include 'row.html' %}"
+                         u"{% endfor %}{% endblock %}"})
+        set_env(self.env)
+
+    def test_module(self):
+        module = get_module_ir(self.env, "row.html")
+        assert module.keys == ["item.name", "title"]
+        assert (JSVisitor().compile_module(module) ==
+                "function module(v1, v2) {return '<tr>' + v1 + v2 + "
+                "'</tr>';}")
+
+    def test_js(self):
+        output = JSVisitor().compile(get_ir(self.env, "page.html"))
+        assert "o += modules['row.html'](r0[0], p0);" in output
+
+    def test_extract(self):
+        data = extract_template(None, "page.html",
+                                {"title": "t", "items": [{"name": "a"}]})
+        assert data == {"title": "t", "for item in items [item.name]": [["a"]]}
+
+
+class TestNumbers(object):
+    """
+    Test that the output of functions that may return a number is joined
+    with the values after it rather than added to them.
+    """
+
+    def setUp(self):
+        self.env = jinja2.Environment()
+        self.env.loader = source_loader({
+            "p.html": u"{{ a }}",
+            "base.html": u"{% block c %}{{ a }}{% endblock %}",
+            "macro.html": u"{% macro m(x) %}{{ x }}{% endmacro %}"
+                          u"{% block c %}{{ m(a) }}{{ b }}{% endblock %}",
+            "include.html": u"{% block c %}{% include 'p.html' %}{{ b }}"
+                            u"{% endblock %}",
+            "super.html": u"{% extends 'base.html' %}"
+                          u"{% block c %}{{ super() }}{{ b }}{% endblock %}",
+            "else.html": u"{% block c %}{% for x in xs %}-{% else %}{{ a }}"
+                         u"{% endfor %}{{ b }}{% endblock %}"})
+
+    def compile(self, name):
+        return JSVisitor().compile(get_ir(self.env, name))
+
+    def test_macro(self):
+        assert "return '' + m_m(param['a']) + param['b'];" in self.compile(
+                "macro.html")
+
+    def test_include(self):
+        assert ("return '' + modules['p.html'](param['a']) + param['b'];" in
+                self.compile("include.html"))
+
+    def test_super(self):
+        assert "return '' + parent.c() + param['b'];" in self.compile(
+                "super.html")
+
+    def test_loop_else(self):
+        assert "return n0 ? o : '' + param['a'];}" in self.compile("else.html")
+
+
+class TestMacros(object):
+    """
+    Test that macros are compiled once and that each call extracts the values
+    that the macro reads.
+    """
+
+    def setUp(self):
+        self.env = jinja2.Environment()
+        self.env.loader = source_loader({
+            "forms.html": u"{% macro input(value) %}"
+                          u"<input value='{{ value }}'>{% endmacro %}",
+            "page.html": u"{% from 'forms.html' import input %}"
+                         u"{% macro row(item) %}<td>{{ item.name|upper }}</td>"
+                         u"{% endmacro %}{% block content %}"
+                         u"{{ input(user.name) }}{% for item in items %}"
+                         u"{{ row(item) }}{% endfor %}{% endblock %}"})
+        set_env(self.env)
+
+    def tearDown(self):
+        set_engine("codegen")
+
+    def test_keys(self):
+        ir = get_ir(self.env, "page.html")
+        assert ir.keys == ["user.name", "for item in items [item.name]"]
+        assert ir.macros["row"].keys == ["item.name"]
+
+    def test_js(self):
+        output = JSVisitor().compile(get_ir(self.env, "page.html"))
+        assert output.startswith("function template(param) {"
+                                 "function m_row(v1) {")
+        assert "o += m_row(r0[0]);" in output
+        assert "modules['forms.html'].input(param['user.name'])" in output
+        module = JSVisitor().compile_module(get_module_ir(self.env,
+                                                          "forms.html"))
+        assert "module.input = m_input;" in module
+
+    def test_extract(self):
+        for engine in ("codegen", "interpreter"):
+            set_engine(engine)
+            data = extract_template(None, "page.html",
+                                    {"user": {"name": "u"},
+                                     "items": [{"name": "a"}]})
+            assert data == {"user.name": "u",
+                            "for item in items [item.name]": [["a"]]}
+
+    def test_constants(self):
+        ir = build_ir(self.env, u"{% macro k(x) %}{% if x %}{{ x }}{% else %}"
+                                u"{{ y }}{% endif %}{% endmacro %}"
+                                u"{% block content %}{{ k(0) }}{{ k(none) }}"
+                                u"{% endblock %}")
+        assert ir.keys == ["y"]
+        assert "m_k(0, p0) + m_k(null, p0)" in JSVisitor().compile(ir)
+
+    def test_context(self):
+        # Macros that are imported without the context don't read the
+        # caller's variables, which are undefined.
+        self.env.loader = source_loader({
+            "tags.html": u"{% macro tag(x) %}<{{ x }}{{ g }}>"
+                         u"{% for i in h %}{{ i }}{% endfor %}{% endmacro %}"})
+        for source, keys, args in (
+                (u"{% from 'tags.html' import tag %}", [], "'', null"),
+                (u"{% import 'tags.html' as tags %}", [], "'', null"),
+                (u"{% from 'tags.html' import tag with context %}",
+                 ["g", "for i in h [i]"],
+                 "param['g'], param['for i in h [i]']")):
+            source += u"{% block content %}{{ tag(1) }}{% endblock %}"
+            if "as tags" in source:
+                source = source.replace("tag(1)", "tags.tag(1)")
+            ir = build_ir(self.env, source)
+            assert ir.keys == keys
+            assert "tag(1, %s" % args in JSVisitor().compile(ir)
+
+    def test_rejected(self):
+        # The extractor doesn't define macros, so calls of the ones that
+        # can't be compiled are an error.
+        self.env.loader = source_loader({
+            "tree.html": u"{% macro tree(node) %}{{ node.name }}"
+                         u"{% for child in node.children %}{{ tree(child) }}"
+                         u"{% endfor %}{% endmacro %}"})
+        for source in (u"{% macro k() %}{{ varargs }}{% endmacro %}"
+                       u"{% block content %}{{ k(1) }}{% endblock %}",
+                       u"{% from 'tree.html' import tree %}"
+                       u"{% block content %}{{ tree(node) }}{% endblock %}"):
+            try:
+                build_ir(self.env, source)
+            except TypeError:
+                pass
+            else:
+                assert False, "The macro was compiled."
+
+
+class TestLoops(object):
+    """
+    Test that loops are passed as the fields that their bodies read.
+    """
+
+    template = (u"{% block content %}{% for item in items if item.shown %}"
+                u"{{ loop.index }}{{ item.name }}{{ title }}"
+                u"{% for tag in item.tags %}{{ tag|upper }}{% endfor %}"
+                u"{% else %}{{ empty }}{% endfor %}{% endblock %}")
+
+    def setUp(self):
+        self.env = jinja2.Environment()
+        self.env.loader = source_loader({"loops.html": self.template})
+        set_env(self.env)
+
+    def tearDown(self):
+        set_engine("codegen")
+
+    def test_fields(self):
+        ir = build_ir(self.env, self.template)
+        key = ("for item in items if item.shown "
+               "[item.name, for tag in item.tags [tag]]")
+        assert ir.keys == ["title", key, "empty"]
+        [loop] = [loop for loop in ir.loops.values() if loop.depth == 0]
+        assert loop.fields == ["item.name", "for tag in item.tags [tag]"]
+
+    def test_entries(self):
+        items = [{"name": "a", "shown": True, "tags": ["x", "y"]},
+                 {"name": "b", "shown": False, "tags": []},
+                 {"name": "c", "shown": True, "tags": []}]
+        key = ("for item in items if item.shown "
+               "[item.name, for tag in item.tags [tag]]")
+        for engine in ("codegen", "interpreter"):
+            set_engine(engine)
+            data = extract_template(None, "loops.html",
+                                    {"items": items, "title": "t"})
+            assert data == {key: [["a", [["x"], ["y"]]], ["c", []]],
+                            "title": "t"}
+            data = extract_template(None, "loops.html",
+                                    {"items": [], "empty": "none"})
+            assert data == {key: [], "title": False, "empty": "none"}
+
+
+class TestEngines(object):
+    """
+    Test that the interpreter extracts the same values as generated code.
+    """
+
+    template = (u"{% set total = price * count %}{% block content %}"
+                u"{% if user.is_staff and total > 10 %}{{ user.name|upper }}"
+                u"{% elif 'b' in tags %}{{ tags[1:]|join(', ') }}"
+                u"{% else %}{{ total // 3 }}{% endif %}"
+                u"{{ 'x' ~ user.name if user else none }}"
+                u"{{ items[key] is defined }}{% endblock %}"
+                u"{% block other %}{{ -total }}{% for tag in tags %}"
+                u"{% set first = tag * 2 %}{{ first }}{{ loop.first }}"
+                u"{% endfor %}{% endblock %}")
+
+    def setUp(self):
+        self.env = jinja2.Environment()
+        self.env.loader = source_loader({"engines.html": self.template})
+        set_env(self.env)
+
+    def tearDown(self):
+        set_engine("codegen")
+
+    def extract(self, engine, context, blocks=None):
+        set_engine(engine)
+        return extract_template(None, "engines.html", context, blocks=blocks)
+
+    def test_same(self):
+        for context in ({"price": 4, "count": 3, "items": {"a": 1},
+                         "key": "a", "user": {"is_staff": True, "name": "x"},
+                         "tags": ["a", "b"]},
+                        {"price": 1, "count": 1, "user": None, "items": {},
+                         "tags": ["a", "b", "c"]},
+                        {"price": 1, "count": 7, "items": {}, "tags": [],
+                         "user": {"name": "y"}}):
+            for blocks in (None, ["other"]):
+                assert (self.extract("interpreter", context, blocks) ==
+                        self.extract("codegen", context, blocks))
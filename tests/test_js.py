@@ -0,0 +1,126 @@
+import jinja2
+
+from jinja2js.ir import analyze
+from jinja2js.jscompiler import JSVisitor
+from jinja2js.optimizer import optimize
+
+
+class TestJS(object):
+    """
+    Test the JS that templates are compiled to.
+    """
+
+    def setUp(self):
+        self.env = jinja2.Environment()
+        self.env.add_extension("jinja2.ext.i18n")
+
+    def compile(self, source, **kwargs):
+        return JSVisitor(**kwargs).compile(analyze(self.env.parse(source)))
+
+    def test_name(self):
+        output = self.compile("{% block content %}{{ foo }}{% endblock %}")
+        assert output == ("function template(param) {return {content: "
+                          "function() {return param['foo'];}};}")
+
+    def test_if(self):
+        output = self.compile("{% block content %}{% if foo %}a{{ bar }}"
+                              "{% else %}b{% endif %}{% endblock %}")
+        assert "function(){" not in output
+        assert "(param['foo'] ? 'a' + param['bar'] : 'b')" in output
+
+    def test_if_without_else(self):
+        output = self.compile("{% block content %}{% if foo %}a{% endif %}"
+                              "{% endblock %}")
+        assert "(param['foo'] ? 'a' : '')" in output
+
+    def test_condexpr(self):
+        output = self.compile("{% block content %}{{ foo if bar }}"
+                              "{% endblock %}")
+        assert "function(){" not in output
+        assert "(param['bar'] ? param['foo'] : '')" in output
+
+    def test_hoisted_lookups(self):
+        output = self.compile("{% block content %}{% if user.name %}"
+                              "{{ user.name }}{% endif %}{{ user.email }}"
+                              "{% endblock %}")
+        assert ("function() {var p0 = param['user.name']; "
+                "return '' + (p0 ? p0 : '') + param['user.email'];}") in output
+
+    def test_join_threshold(self):
+        source = "{% block content %}{{ a }}<br>{{ b }}{% endblock %}"
+        assert ("return param['a'] + '<br>' + param['b'];" in
+                self.compile(source))
+        assert ("return [param['a'], '<br>', param['b']].join('');" in
+                self.compile(source, join_threshold=3))
+
+    def test_for(self):
+        output = self.compile("{% block content %}{% for item in items %}"
+                              "{{ item.name }}{{ title }}{% endfor %}"
+                              "{% endblock %}")
+        assert "function(){" not in output
+        assert ("function l0(a0) {var o = '', n0 = a0 ? a0.length : 0, i0, "
+                "r0; for (i0 = 0; i0 < n0; i0++) {r0 = a0[i0]; "
+                "o += '' + r0[0] + p0;} return o;}") in output
+        assert "return l0(param['for item in items [item.name]']);" in output
+
+    def test_numbers(self):
+        # Numbers that are output next to each other aren't summed.
+        output = self.compile("{% block content %}{% for item in items %}"
+                              "{{ loop.index }}{{ item.count }};{% endfor %}"
+                              "{{ a }}{{ b }}{% endblock %}")
+        assert "o += '' + (i0 + 1) + r0[0] + ';';" in output
+        assert ("return l0(param['for item in items [item.count]']) + " in
+                output)
+        output = self.compile("{% block content %}{{ a }}{{ b }}"
+                              "{% endblock %}")
+        assert "return '' + param['a'] + param['b'];" in output
+
+    def test_loop_helpers(self):
+        output = self.compile("{% block content %}{% for item in items %}"
+                              "{{ loop.index }}{{ loop.cycle('a', 'b') }}"
+                              "{% if loop.last %}!{% endif %}{% else %}-"
+                              "{% endfor %}{% endblock %}")
+        assert ("o += '' + (i0 + 1) + ['a', 'b'][i0 % 2] + "
+                "((i0 === n0 - 1) ? '!' : '');} return n0 ? o : '-';}" in
+                output)
+
+    def test_filters(self):
+        output = self.compile("{% block content %}{{ name|upper }}"
+                              "{{ name|truncate(10, end='~') }}"
+                              "{{ name|truncate(killwords=true, foo=1) }}"
+                              "{% endblock %}")
+        assert output.startswith("function template(param) {var filters = "
+                                 "jinja2js.filters; ")
+        assert "filters.upper(p0)" in output
+        assert "filters.truncate(p0, 10, null, '~')" in output
+        # Arguments that the runtime doesn't take are passed to the server.
+        assert "param['name|truncate(killwords=True, foo=1)']" in output
+
+
+class TestOptimizer(object):
+    """
+    Test the optimizations that are made before templates are compiled.
+    """
+
+    def setUp(self):
+        self.env = jinja2.Environment()
+
+    def compile(self, source):
+        ast = self.env.parse("{%% block content %%}%s{%% endblock %%}" %
+                             source)
+        return JSVisitor().compile(analyze(optimize(ast, self.env)))
+
+    def test_merge_literals(self):
+        output = self.compile("<p>{{ 'Hello' }} {{ 42 }}</p>{{ foo }}")
+        assert "return '<p>Hello 42</p>' + param['foo'];" in output
+
+    def test_fold_constants(self):
+        output = self.compile("{{ foo }}{{ 1 + 2 * 3 }}")
+        assert "return '' + param['foo'] + 7;" in output
+
+    def test_dead_branches(self):
+        output = self.compile("{% if 1 > 2 %}{{ foo }}{% else %}{{ bar }}"
+                              "{% endif %}{{ zap if false }}")
+        assert "foo" not in output
+        assert "zap" not in output
+        assert "return param['bar'];" in output
@@ -1,8 +1,16 @@
+import gc
 import os
+import shutil
+import tempfile
+import threading
+import weakref
 
 import jinja2
 
 import jinja2js
+from jinja2js import bccache, extractor, revrender
+from jinja2js.bccache import FileSystemExtractorCache
+from jinja2js.jscompiler import get_js
 
 
 class MockRequest(object):
@@ -59,3 +67,338 @@ class TestJSON(object):
         print data
         assert data["fooifbarelsezap"] == "abc"
 
+
+
+class TestExtractorCache(object):
+    """
+    Test that compiled extractors are reused until their source changes.
+    """
+
+    def setUp(self):
+        self.templates = {"cached.html": "{% block content %}{{ foo }}"
+                                         "{% endblock %}"}
+        self.env = jinja2.Environment(
+                loader=jinja2.FunctionLoader(self.load))
+        self.request = MockRequest()
+        jinja2js.set_env(self.env)
+
+    def load(self, name):
+        source = self.templates[name]
+        return source, None, lambda: self.templates[name] == source
+
+    def test_reused(self):
+        first = jinja2js.revrender.get_extractor(self.env, "cached.html")
+        second = jinja2js.revrender.get_extractor(self.env, "cached.html")
+        assert first is second
+
+    def test_invalidated(self):
+        data = jinja2js.extract_template(self.request, "cached.html",
+                                         {"foo": "abc", "bar": "def"})
+        assert "bar" not in data
+
+        self.templates["cached.html"] = ("{% block content %}{{ bar }}"
+                                         "{% endblock %}")
+        data = jinja2js.extract_template(self.request, "cached.html",
+                                         {"foo": "abc", "bar": "def"})
+        assert data["bar"] == "def"
+
+
+class TestBytecodeCache(object):
+    """
+    Test that extractor bytecode is stored in and loaded from the bytecode
+    cache.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.env = jinja2.Environment(
+                loader=jinja2.FileSystemLoader(
+                    os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 "templates")))
+        self.request = MockRequest()
+        jinja2js.set_env(self.env)
+        jinja2js.set_bytecode_cache(FileSystemExtractorCache(self.directory))
+
+    def tearDown(self):
+        jinja2js.set_bytecode_cache(None)
+        jinja2js.revrender.clear_caches()
+        shutil.rmtree(self.directory)
+
+    def test_stored(self):
+        jinja2js.extract_template(self.request, "name.html", {"foo": "abc"})
+        assert len(os.listdir(self.directory)) == 1
+
+    def test_loaded(self):
+        jinja2js.extract_template(self.request, "name.html", {"foo": "abc"})
+        jinja2js.revrender.clear_caches()
+
+        # The extractor is loaded from the cache instead of being generated.
+        generated = []
+        generate = extractor.JSONVisitor.generate
+        extractor.JSONVisitor.generate = (
+                lambda *args: generated.append(args) or generate(*args))
+        try:
+            data = jinja2js.extract_template(self.request, "name.html",
+                                             {"foo": "def"})
+        finally:
+            extractor.JSONVisitor.generate = generate
+        assert data["foo"] == "def"
+        assert generated == []
+
+    def test_format_version(self):
+        # Bytecode of extractors in an older format isn't loaded.
+        cache = FileSystemExtractorCache(self.directory)
+        checksum = cache.get_source_checksum(u"source")
+        bccache.FORMAT_VERSION += 1
+        try:
+            assert cache.get_source_checksum(u"source") != checksum
+        finally:
+            bccache.FORMAT_VERSION -= 1
+
+    def test_dependencies(self):
+        templates = {"base.html": "{% block content %}{{ foo }}{% endblock %}",
+                     "child.html": "{% extends 'base.html' %}"}
+        self.env.loader = jinja2.FunctionLoader(
+                lambda name: (templates[name], None, lambda: True))
+        jinja2js.extract_template(self.request, "child.html", {"foo": 1})
+        jinja2js.revrender.clear_caches()
+
+        # The cached extractor is loaded without the templates being parsed.
+        built = []
+        get_ir = extractor.get_ir
+        extractor.get_ir = lambda *args: built.append(args) or get_ir(*args)
+        try:
+            data = jinja2js.extract_template(self.request, "child.html",
+                                             {"foo": 2})
+            assert data == {"foo": 2}
+            assert built == []
+
+            # It's compiled again once a template that it extends changes.
+            jinja2js.revrender.clear_caches()
+            templates["base.html"] = ("{% block content %}{{ bar }}"
+                                      "{% endblock %}")
+            data = jinja2js.extract_template(self.request, "child.html",
+                                             {"bar": 3})
+            assert data == {"bar": 3}
+            assert len(built) == 1
+        finally:
+            extractor.get_ir = get_ir
+
+
+class TestDelta(object):
+    """
+    Test that delta payloads only hold the values that changed.
+    """
+
+    def setUp(self):
+        source = ("{% block content %}{{ foo }}{% if bar %}{{ zap }}"
+                  "{% endif %}{% endblock %}")
+        self.env = jinja2.Environment(
+                loader=jinja2.FunctionLoader(
+                    lambda name: (source, None, lambda: True)))
+        self.request = MockRequest()
+        jinja2js.set_env(self.env)
+
+    def test_full(self):
+        data, token = jinja2js.extract_delta(self.request, "delta.html",
+                                             {"foo": 1})
+        assert data == {"foo": 1, "bar": False, "zap": None}
+
+        data, token = jinja2js.extract_delta(self.request, "delta.html",
+                                             {"foo": 1}, "0badc0de:")
+        assert "__delta__" not in data
+
+    def test_changed(self):
+        data, token = jinja2js.extract_delta(self.request, "delta.html",
+                                             {"foo": 1, "bar": True})
+        data, token = jinja2js.extract_delta(self.request, "delta.html",
+                                             {"foo": 1, "bar": True,
+                                              "zap": 2}, token)
+        assert data == {"__delta__": 1, "zap": 2}
+
+        data, token = jinja2js.extract_delta(self.request, "delta.html",
+                                             {"foo": 3, "bar": True,
+                                              "zap": 2}, token, compact=True)
+        assert data == {"__delta__": 1, "0": token.split(":")[0], "1": 3}
+
+
+class TestETag(object):
+    """
+    Test the digests that are used as ETags and to reuse serialized payloads.
+    """
+
+    def setUp(self):
+        self.request = MockRequest()
+        self.request.META = {}
+
+    def test_digest(self):
+        digest = extractor.payload_digest({"foo": 1, "bar": u"x"})
+        assert digest == extractor.payload_digest({"bar": u"x", "foo": 1})
+        assert digest != extractor.payload_digest({"foo": 2, "bar": u"x"})
+
+    def test_canonical(self):
+        # Equal values extract to payloads with the same digest.
+        shared = jinja2js.Extractor(jinja2.Environment(
+                loader=jinja2.DictLoader({"t.html": "{% block content %}"
+                                          "{{ foo }}{{ bar|join }}"
+                                          "{% endblock %}"})))
+        digests = set()
+        for foo, bar in (("x", {"a": 1, "b": 2}), (u"x", {"b": 2, "a": 1})):
+            digests.add(extractor.payload_digest(shared.extract_template(
+                    None, "t.html", {"foo": foo, "bar": bar})))
+        assert len(digests) == 1
+
+    def test_serialized_once(self):
+        payload = {"foo": 1}
+        digest = extractor.payload_digest(payload)
+        shared = jinja2js.Extractor(jinja2.Environment())
+        body = shared.serialize(payload, digest)
+        assert shared.serialize({"foo": 1}, digest) is body
+        assert shared.serialize({"foo": 1}) is body
+
+    def test_if_none_match(self):
+        assert not extractor.etag_matches(self.request, '"abc"')
+        self.request.META["HTTP_IF_NONE_MATCH"] = 'W/"def", "abc"'
+        assert extractor.etag_matches(self.request, '"abc"')
+        assert not extractor.etag_matches(self.request, '"ghi"')
+
+
+class TestBlocks(object):
+    """
+    Test that only the values read by the requested blocks are extracted.
+    """
+
+    def setUp(self):
+        source = ("{% set x = foo|upper %}{% block a %}{{ x }}{% endblock %}"
+                  "{% block b %}{{ bar.baz }}{% endblock %}")
+        self.env = jinja2.Environment(
+                loader=jinja2.FunctionLoader(
+                    lambda name: (source, None, lambda: True)))
+        self.request = MockRequest()
+        jinja2js.set_env(self.env)
+
+    def test_selected(self):
+        ctx = {"foo": "abc", "bar": {"baz": 1}}
+        data = jinja2js.extract_template(self.request, "blocks.html", ctx,
+                                         blocks=["a"])
+        assert data == {"x": "ABC"}
+
+        data = jinja2js.extract_template(self.request, "blocks.html", ctx,
+                                         blocks=["b"])
+        assert data == {"bar.baz": 1}
+
+    def test_delta_keeps_other_blocks(self):
+        ctx = {"foo": "abc", "bar": {"baz": 1}}
+        data, token = jinja2js.extract_delta(self.request, "blocks.html", ctx)
+
+        ctx = {"foo": "def", "bar": {"baz": 2}}
+        data, token = jinja2js.extract_delta(self.request, "blocks.html", ctx,
+                                             token, blocks=["b"])
+        assert data == {"__delta__": 1, "bar.baz": 2}
+
+        data, token = jinja2js.extract_delta(self.request, "blocks.html", ctx,
+                                             token)
+        assert data == {"__delta__": 1, "x": "DEF"}
+
+
+class TestProcessors(object):
+    """
+    Test that context processors are only run for templates that read what
+    they provide.
+    """
+
+    def test_provides(self):
+        @jinja2js.provides("cart")
+        def cart(request):
+            return {"cart": 1}
+
+        assert extractor.processor_keys(cart) == frozenset(["cart"])
+
+    def test_known(self):
+        def request(request):
+            return {"request": request}
+        request.__module__ = "django.core.context_processors"
+
+        assert extractor.processor_keys(request) == ("request",)
+        assert extractor.processor_keys(lambda request: {}) is None
+
+
+class TestExtractor(object):
+    """
+    Test that extractors are bound to their environment and can be shared
+    between threads.
+    """
+
+    def setUp(self):
+        self.loads = 0
+
+    def environment(self, source):
+        def load(name):
+            self.loads += 1
+            return source, None, lambda: True
+        return jinja2.Environment(loader=jinja2.FunctionLoader(load))
+
+    def test_environments(self):
+        first = jinja2js.Extractor(self.environment(
+                "{% block content %}{{ foo }}{% endblock %}"))
+        second = jinja2js.Extractor(self.environment(
+                "{% block content %}{{ bar }}{% endblock %}"),
+                engine="interpreter")
+
+        ctx = {"foo": 1, "bar": 2}
+        assert first.extract_template(None, "t.html", ctx) == {"foo": 1}
+        assert second.extract_template(None, "t.html", ctx) == {"bar": 2}
+
+    def test_threads(self):
+        shared = jinja2js.Extractor(self.environment(
+                "{% block content %}{{ foo.bar }}{% endblock %}"))
+        results = []
+
+        def extract():
+            for i in range(20):
+                results.append(shared.extract_template(
+                        None, "t.html", {"foo": {"bar": i}})["foo.bar"])
+
+        threads = [threading.Thread(target=extract) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert sorted(results) == sorted(range(20) * 8)
+        # The source is loaded once for the IR and once for the extractor.
+        assert self.loads == 2
+
+    def test_released(self):
+        # Replacing the environment lets the old one and its extractor go.
+        environment = self.environment("{% block content %}{% endblock %}")
+        jinja2js.set_env(environment)
+        revrender.get_extractor_for(environment)
+        released = weakref.ref(environment)
+        jinja2js.set_env(self.environment(""))
+        del environment
+        gc.collect()
+        assert released() is None
+
+    def test_released_after_extracting(self):
+        # Nothing that is cached for an environment keeps it alive.
+        environment = self.environment(
+                "{% block content %}{{ foo }}{% endblock %}")
+        for engine in extractor.ENGINES:
+            jinja2js.Extractor(environment, engine).extract_template(
+                    None, "t.html", {"foo": 1})
+        get_js(environment, "t.html")
+        released = weakref.ref(environment)
+        del environment
+        gc.collect()
+        assert released() is None
+
+    def test_phases(self):
+        shared = jinja2js.Extractor(self.environment(
+                "{% block content %}{{ foo }}{% endblock %}"))
+        assert shared.processors("t.html") == []
+
+        root, output = shared.evaluate("t.html", {"foo": 1})
+        assert (shared.payload(root, output, compact=True) ==
+                shared.extract_template(None, "t.html", {"foo": 1},
+                                        compact=True))
@@ -0,0 +1,44 @@
+import jinja2
+
+import jinja2js
+from jinja2js.cache import CACHE_SIZE
+from jinja2js.jscompiler import scripts
+from jinja2js.revrender import get_extractor_for
+
+
+class TestWarmup(object):
+    """
+    Test that warming up an environment compiles every template.
+    """
+
+    def setUp(self):
+        self.env = jinja2.Environment(loader=jinja2.DictLoader({
+            "good.html": "{% block content %}{{ foo }}{% endblock %}",
+            "bad.html": "{% block content %}{{ foo }",
+        }))
+
+    def test_warmup(self):
+        results = dict((r.name, r) for r in jinja2js.warmup(self.env))
+        assert sorted(results) == ["bad.html", "good.html"]
+
+        assert results["good.html"].error is None
+        assert isinstance(results["bad.html"].error,
+                          jinja2.TemplateSyntaxError)
+
+        assert "good.html" in get_extractor_for(self.env).cache.get_cache(
+                self.env)
+        assert "good.html" in scripts.get_cache(self.env)
+
+    def test_many(self):
+        # Every template stays cached, however many there are.
+        env = jinja2.Environment(loader=jinja2.DictLoader(dict(
+                ("%d.html" % i, "{% block content %}{{ foo }}{% endblock %}")
+                for i in range(CACHE_SIZE * 2))))
+        extractor = jinja2js.Extractor(env, engine="interpreter")
+        results = jinja2js.warmup(env, extractor=extractor)
+        assert len(results) == CACHE_SIZE * 2
+        assert all(result.error is None for result in results)
+
+        for result in results:
+            assert result.name in extractor.cache.get_cache(env)
+            assert result.name in scripts.get_cache(env)